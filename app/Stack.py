@@ -1,30 +1,113 @@
-import RPi.GPIO as GPIO
-import smbus
 import time
-import bme280
-from Adafruit_PCA9685 import PCA9685
-from multiprocessing import Process, Manager, Lock
-
-def create_updates():
-    retv = {"boards":{}, "find_bme":False}
-    for i in range(4): 
-        retv["boards"][i] = {}
-        for j in range(1,5):
-          retv["boards"][i][j] = {"state":0, "updated":0}
-    retv['pwm'] = {'clock':{}}
-    retv['pwm']['clock']['freq'] = 50
-    retv['pwm']['clock']['updated'] = False
-    for i in range(16): 
-        retv['pwm'][i] = {}
-        retv['pwm'][i]['val'] = 0
-        retv['pwm'][i]['updated'] = False 
-    
-    retv['rpi_pwm'] = {}
-    for i in range(2): retv['rpi_pwm'][i] ={'value':1,'updated':0}
-    return retv
+import bme
+import hardware
+import pca9685
+from hardware import GPIO, SMBus
+import os
+import json
+import queue
+from collections import deque
+from multiprocessing import Process, Queue, Value, Event
+from telemetry_block import TelemetryBlock, HISTOGRAMS
+from i2c_bus import MuxBus
+from scheduler import BusScheduler, ACTUATION, TELEMETRY
+from recorder import Recorder, new_session
+from metrics import Histogram
+
+# Commands sent from the API process to the acquisition process, each one queued with
+# the time.monotonic() it was issued at. Only the changed item travels, the last
+# element is always the new value:
+#   ('switch', board, channel, state)
+#   ('pwm', channel, percentage)
+#   ('pwm_freq', freq)
+#   ('rpi_pwm', pin, freq)
+#   ('sampling', device_class, config)
+#   ('recording', session)   session None stops the recorder
+#   ('batch', operations)    switch and pwm commands applied together, one write per board
+#   ('move', moves)          PWM channels ramped to new targets, see start_moves_()
+def command_key(command):
+    # Commands with the same key supersede each other, a batch or move only an identical one
+    if command[0] in ('batch', 'move'):
+        return command
+    return command[:-1]
+
+# Commands whose latency, from the API call to the bus write, is measured
+ACTUATION_COMMANDS = ('switch', 'pwm', 'pwm_freq', 'rpi_pwm', 'batch', 'move')
+# Bus jobs whose run time is measured
+BUS_JOBS = ('read_current', 'trigger_bme', 'read_bme', 'apply_command', 'end_cycle', 'trajectory_tick')
+# PWM moves are stepped at this rate, one servo frame at 50 Hz
+TRAJECTORY_RATE = 50.0
+
+# Sampling per device class. 'rate' is the full rate in Hz. In adaptive mode a device
+# whose primary field stays within 'change' of its reference halves its rate, down to
+# 'min_rate'; a bigger change, or a reading at or above 'limit', restores the full rate.
+SAMPLING_DEFAULTS = {
+    'current': {'rate': 50.0, 'adaptive': False, 'min_rate': 5.0, 'change': 0.2, 'limit': None},
+    'bme':     {'rate': 1.0,  'adaptive': False, 'min_rate': 0.1, 'change': 0.2, 'limit': None,
+                'mode': 'forced', 'oversampling': 1},
+}
+# 'forced': every due BME is triggered, and all of them are read once the conversion is done.
+# 'normal': the BMEs free-run with the configured oversampling and are only read.
+BME_MODES = ('forced', 'normal')
+PRIMARY_FIELDS = {'current': 'current', 'bme': 'temperature'}
+MAX_SAMPLING_RATE = 200.0
 
+# Power monitor address by channel on a sensor board
+CURRENT_SENSOR_ADDRESSES = {1: 0b1110000, 2: 0b1110011, 3: 0b1111100, 4: 0b1111111}
 
+def bme_slot(key):
+    # BME position behind the two muxes, as reported by the API (1 to 16)
+    return key[0]*8 + key[1]+1
 
+# Boards and BME calibrations found by the last discovery, so a restart can serve from
+# them at once while the bus is probed again in the background
+TOPOLOGY_CACHE = os.environ.get('ASC_TOPOLOGY_CACHE', f'/root/.config/asc/topology-{hardware.HARDWARE}.json')
+# 'discovering': no cache, devices appear as they are found
+# 'verifying': serving the cached topology while it is checked
+# 'ready': every mux position has been probed
+DISCOVERY_STATES = ('discovering', 'verifying', 'ready')
+# Once ready, the empty mux positions are probed again this often, so late or reseated
+# devices are picked up
+REDISCOVERY_INTERVAL = float(os.environ.get('ASC_REDISCOVERY_INTERVAL', 5.0))
+# A device in use is probed again after this many failed reads in a row, and dropped
+# if it no longer answers
+MISSING_AFTER = 5
+# Expander output registers are only written from a shadow copy, and read back this
+# often in idle bus time to catch drift, e.g. a board that browned out
+OUTPUT_VERIFY_INTERVAL = float(os.environ.get('ASC_OUTPUT_VERIFY_INTERVAL', 1.0))
+EXPANDER_ADDRESS = 0b1000001
+
+def load_topology(path=TOPOLOGY_CACHE):
+    # Returns (boards, bmes) from the cache, None when there is no usable cache
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        boards = [int(board) for board in data['boards']]
+        bmes = {}
+        for key, calibration in data['bmes'].items():
+            ch1, ch2 = key.split('/')
+            bmes[(int(ch1), int(ch2))] = bme.Calibration(*calibration)
+        return boards, bmes
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring topology cache {path}: {e}")
+        return None
+
+def save_topology(boards, bmes, path=TOPOLOGY_CACHE):
+    data = {
+        'saved': time.time(),
+        'boards': sorted(boards),
+        'bmes': {f'{key[0]}/{key[1]}': list(calibration) for key, calibration in sorted(bmes.items())},
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to the old one and renamed, a power cut never leaves half a file
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        print(f"Failed to save topology cache {path}: {e}")
 
 
 class Stack:
@@ -40,66 +123,170 @@ class Stack:
         #     self.rpi_pwm_pins[cnt].start(50)	
 
 
-        self.bus = smbus.SMBus(self.i2c_bus)
-        self.boards = []
-        self.bmes   = {}
-        manager = Manager()
-        self.updates = manager.dict(create_updates())
-        self.find_all_boards_()
-        self.current_sense = manager.dict(self.get_all_current())
-        self.find_all_bme_()
-        self.bme_sense     = manager.dict(self.get_all_bme_())
+        self.bus = MuxBus(SMBus(self.i2c_bus))
+        # Served from the cache until discovery in the acquisition process confirms it
+        cached = load_topology()
+        self.boards, self.bmes = cached if cached else ([], {})
+        self.discovery_state = 'verifying' if cached else 'discovering'
+        # Boards whose expander has been set up since the start
+        self.probed_boards = set()
+        # Mux positions waiting to be probed, one per idle gap in the acquisition loop
+        self.discovery = deque()
+        self.next_rediscovery = 0
+        # Requested output register per board, and when each board is read back next
+        self.outputs = {}
+        self.output_checks = {}
+        self.output_repairs = 0
+        self.last_readback = {}
+        self.configured_sensors = set()
+        # Actuation requests, applied by the acquisition loop between two device reads
+        self.commands = Queue()
+        # Filled by the acquisition process and copied into the telemetry block every cycle
+        self.latency = {name: Histogram() for name in HISTOGRAMS}
+        # Run time of every kind of bus job, by job method name
+        self.scheduler = BusScheduler({job + '_': self.latency['job_' + job] for job in BUS_JOBS})
+        self.sampling = {kind: dict(config) for kind, config in SAMPLING_DEFAULTS.items()}
+        self.device_state = {}
+        # Latest samples live in shared memory, readers never go through the manager.
+        # sample_ready is set after each published sweep so the API process can push it out once.
+        self.telemetry = TelemetryBlock()
+        self.sample_ready = Event()
+        # Only used by the acquisition process, which owns the sample stream
+        self.recorder = Recorder()
+        self.recording = None
         self.pwm = None
         self.freq = None
-        self.setup_pwm_chip_()
-        self.set_pwm_freq_(50)
-        
+        # Last percentage per PWM channel, and the moves in progress:
+        # channel -> (start, target, time.monotonic() started, duration)
+        self.pwm_levels = {}
+        self.trajectories = {}
+        self.next_tick = 0
+        self.publish_topology_()
 
-        self.flag = manager.Value('b', True)
-        self.flag.value = True
+        # No bus traffic before the process starts, the API serves right away
+        self.flag = Value('b', True)
         self.proc = Process(target=self.update_)
         self.proc.start()
-        print(self.updates['pwm'])
+        if os.environ.get('ASC_RECORD') == '1':
+            self.set_recording(True)
         
     
     #____________________________________________________________________#
     # Only make use of the following functions #
     #____________________________________________________________________#
     def switch(self, board, channel, state):
-        updates_key = self.updates["boards"]
-        updates_key[board][channel]['state'] = state
-        updates_key[board][channel]['updated'] = True
-        self.updates["boards"] = updates_key
+        self.send_command_(('switch', board, channel, state))
     
     def get_current_sensor_data(self):
-        return dict(self.current_sense)
+        return self.telemetry.read_current()
     
     def get_bme_data(self):
-        return dict(self.bme_sense)
+        return self.telemetry.read_bme()
     
     def set_pwm_out(self, channel, percentage):
-        updates_key = self.updates["pwm"]
-        updates_key[channel]['val'] = percentage
-        updates_key[channel]['updated'] = True
-        self.updates['pwm'] = updates_key
-        print(self.updates['pwm'])
+        self.send_command_(('pwm', channel, percentage))
     
     def set_pwm_freq(self, freq):
-        updates_key = self.updates["pwm"]
-        updates_key['clock']['freq'] = freq
-        updates_key['clock']['updated'] = True
-        self.updates['pwm'] = updates_key
+        self.send_command_(('pwm_freq', freq))
     
     def set_rpi_pwm(self, pin, freq):
-        updates_key = self.updates["rpi_pwm"]
-        updates_key[pin]['value'] = freq
-        updates_key[pin]['updated'] = True
-        self.updates["rpi_pwm"] = updates_key
+        self.send_command_(('rpi_pwm', pin, freq))
+
+    def batch(self, operations):
+        # operations: ('switch', board, channel, state) and ('pwm', channel, percentage)
+        # tuples, applied as one command in the order given
+        self.send_command_(('batch', tuple(tuple(op) for op in operations)))
+
+    def move_pwm(self, moves):
+        # moves: (channel, percentage, ramp time in s or None, velocity in %/s or None)
+        # tuples, stepped by the acquisition loop at TRAJECTORY_RATE
+        self.send_command_(('move', tuple(tuple(move) for move in moves)))
+
+    def get_sampling(self):
+        return {kind: dict(config) for kind, config in self.sampling.items()}
+
+    def set_sampling(self, kind, **changes):
+        # Returns the new configuration of the class, raises ValueError on bad input
+        if kind not in self.sampling:
+            raise ValueError(f"Unknown device class {kind}")
+        config = dict(self.sampling[kind])
+        for field, value in changes.items():
+            if field not in config:
+                raise ValueError(f"Unknown sampling setting {field}")
+            config[field] = value
+        # Everything is checked before anything is applied
+        number = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+        for field in ('rate', 'min_rate', 'change'):
+            if not number(config[field]) or config[field] <= 0:
+                raise ValueError(f"{field} must be a positive number")
+        if not isinstance(config['adaptive'], bool):
+            raise ValueError("adaptive must be true or false")
+        if config['limit'] is not None and not number(config['limit']):
+            raise ValueError("limit must be a number or null")
+        if not (0 < config['min_rate'] <= config['rate'] <= MAX_SAMPLING_RATE):
+            raise ValueError(f"Rates must satisfy 0 < min_rate <= rate <= {MAX_SAMPLING_RATE}")
+        if kind == 'bme' and config['mode'] not in BME_MODES:
+            raise ValueError(f"BME mode must be one of {BME_MODES}")
+        if kind == 'bme' and config['oversampling'] not in bme.OVERSAMPLING:
+            raise ValueError(f"BME oversampling must be one of {tuple(bme.OVERSAMPLING)}")
+        self.sampling[kind] = config
+        self.send_command_(('sampling', kind, config))
+        return dict(config)
+
+    def get_bus_stats(self):
+        return self.telemetry.read_stats()
+
+    def get_latency(self):
+        # Histograms of the acquisition loop: name -> (bucket counts, sum, count)
+        return self.telemetry.read_histograms()
+
+    def get_topology(self):
+        # Discovery state and the boards and BME slots in use
+        state, boards, bme_slots = self.telemetry.read_topology()
+        return {'state': DISCOVERY_STATES[state], 'boards': boards, 'bmes': bme_slots}
+
+    def get_switch_state(self):
+        # Requested and read back outputs per board
+        return self.telemetry.read_outputs()
+
+    def get_command_backlog(self):
+        return self.commands.qsize()
+
+    def get_recording(self):
+        return self.recording
+
+    def set_recording(self, enabled):
+        # Returns the session name, a new session is started on every enable
+        self.recording = new_session() if enabled else None
+        self.send_command_(('recording', self.recording))
+        return self.recording
+
+    def get_sample(self):
+        return self.telemetry.read()
+
+    def wait_for_sample(self, timeout=None):
+        # Blocks until the acquisition process publishes a new sweep, None on timeout.
+        # Meant for a single consumer, the telemetry feed thread.
+        if not self.sample_ready.wait(timeout):
+            return None
+        self.sample_ready.clear()
+        return self.telemetry.read()
 
     #____________________________________________________________________#
 
+    def send_command_(self, command):
+        self.commands.put((command, time.monotonic()))
+
     def update_(self):
         flag = True
+        self.cycles = 0
+        # Full sweeps: every power monitor channel in use read once
+        self.sweeps = 0
+        self.sweep_unread = None
+        self.reads = {kind: 0 for kind in self.sampling}
+        self.setup_pwm_chip_()
+        self.set_pwm_freq_(50)
+        self.start_discovery_()
         while(flag):
             try:
                 if self.rpi_pwm_pins is None:
@@ -111,194 +298,502 @@ class Stack:
                         self.rpi_pwm_pins.append(GPIO.PWM(pin,1))
                         self.rpi_pwm_pins[-1].start(50)
 
-                retv = self.get_all_current()
-                for key in retv:
-                    sense_key = self.current_sense[key]
-                    for key2 in retv[key]:
-                        sense_key[key2] = retv[key][key2]
-                    self.current_sense[key] = sense_key
-
-                # Safely access pwm dictionary
-                try:
-                    retv = self.updates.copy()
-                    if 'pwm' in retv and isinstance(retv['pwm'], dict):
-                        updates_key = self.updates.get('pwm', {})
-                        if 'clock' in updates_key and isinstance(updates_key['clock'], dict):
-                            updates_key['clock']['updated'] = False
-                            for i in range(16): 
-                                if i in updates_key and isinstance(updates_key[i], dict):
-                                    updates_key[i]['updated'] = False
-                            self.updates['pwm'] = updates_key
-
-                        if 'clock' in retv['pwm'] and retv['pwm']['clock'].get('updated', False):
-                            self.set_pwm_freq_(retv['pwm']['clock'].get('freq', 50))
-                        for i in range(16): 
-                            if i in retv['pwm'] and retv['pwm'][i].get('updated', False):
-                                self.set_pwm_(i, retv['pwm'][i].get('val', 0))
-                except Exception as e:
-                    print(f"Error updating PWM: {e}")
-
-                # Safely handle boards and rpi_pwm dictionaries
-                try:
-                    # __________________________________ Motors ________________________________
-                    retv = self.updates.copy()
-                    
-                    # Handle boards dictionary safely
-                    if 'boards' in self.updates:
-                        updates_key = self.updates.get('boards', {})
-                        for key in updates_key:
-                            for key2 in updates_key.get(key, {}):
-                                updates_key[key][key2]['updated'] = 0
-                        self.updates['boards'] = updates_key
-                    
-                    # Handle rpi_pwm dictionary safely
-                    if 'rpi_pwm' in self.updates:
-                        updates_key2 = self.updates.get('rpi_pwm', {})
-                        for key in updates_key2:
-                            updates_key2[key]['updated'] = 0
-                        self.updates['rpi_pwm'] = updates_key2
-
-                    # Process board updates
-                    if 'boards' in retv:
-                        for key in retv.get('boards', {}):
-                            for key2 in retv['boards'].get(key, {}):
-                                if retv['boards'][key][key2].get('updated', False): 
-                                    self.switch_(key, key2, retv['boards'][key][key2].get('state', 0))
-                     
-                    # Process rpi_pwm updates
-                    if 'rpi_pwm' in retv and self.rpi_pwm_pins:
-                        for cnt in range(2):
-                            if cnt in retv.get('rpi_pwm', {}) and retv['rpi_pwm'][cnt].get('updated', False): 
-                                self.rpi_pwm_pins[cnt].ChangeFrequency(retv['rpi_pwm'][cnt].get('value', 1))
-                except Exception as e:
-                    print(f"Error updating motors: {e}")
-                     # ___________________________________________________________________________
-
-                retv = self.get_all_bme_()
-                for key in retv:
-                    sense_key = self.bme_sense[key]
-                    for key2 in retv[key]:
-                        sense_key[key2] = retv[key][key2]
-                    self.bme_sense[key] = sense_key
-                flag = self.flag.value
+                wait = 0
+                if not self.scheduler.pending():
+                    flag = self.flag.value
+                    wait = self.schedule_due_()
+                    if wait > 0 and self.submit_idle_job_():
+                        wait = 0
+                wait = self.schedule_tick_(wait)
+                # Commands are picked up before every job, so an actuation waits for
+                # at most one device read. With nothing due, sleep until a command arrives.
+                self.poll_commands_(timeout=min(wait, 0.1))
+                self.scheduler.run_next()
             except Exception as e:
                 print(f"Error in update loop: {e}")
                 time.sleep(0.5)  # Add delay to prevent rapid error loops
+        self.recorder.stop()
 
-    def swap_multiplexer_(self, num, channel):
-        if(num==1):   address = 0x77
-        elif(num==2): address = 0x71
-        else :        return False
-        if(channel < 0 or channel>7): return False
-        value = 1<<channel
+    def poll_commands_(self, timeout=0):
+        # Drain everything queued so far, keeping only the newest value per target
+        pending = {}
+        try:
+            item = self.commands.get(timeout=timeout) if timeout > 0 else self.commands.get_nowait()
+            while True:
+                pending.pop(command_key(item[0]), None)
+                pending[command_key(item[0])] = item
+                item = self.commands.get_nowait()
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        for command, issued in pending.values():
+            # Same population as the dispatch and apply stages
+            if command[0] in ACTUATION_COMMANDS:
+                self.latency['command_queue'].observe(now - issued)
+            self.scheduler.submit(ACTUATION, self.apply_command_, command, issued)
+
+    def devices_(self):
+        for board in sorted(self.boards):
+            for i in range(1,5):
+                yield ('current', board, i)
+        # Sorted by mux path, so each primary channel is selected once per batch
+        for key in sorted(self.bmes):
+            yield ('bme', key)
+
+    def schedule_due_(self):
+        # Queues a read job for every device that is due, returns how long to sleep otherwise
+        now = time.monotonic()
+        due = []
+        next_due = now + 0.1
+        for device in self.devices_():
+            state = self.device_state.get(device)
+            if state is None:
+                state = self.device_state[device] = {'next_due': now, 'interval': 1.0 / self.sampling[device[0]]['rate'], 'ref': None, 'ready_at': None, 'failures': 0}
+            # A triggered BME is due again once its conversion is done
+            wake = state['next_due'] if state['ready_at'] is None else state['ready_at']
+            if wake <= now:
+                due.append(device)
+            else:
+                next_due = min(next_due, wake)
+        if not due:
+            return next_due - now
+        self.cycle_start = now
+        self.sweep_current = {}
+        self.sweep_bme = {}
+        forced = self.sampling['bme']['mode'] == 'forced'
+        for device in due:
+            if device[0] == 'current':
+                self.scheduler.submit(TELEMETRY, self.read_current_, device)
+            elif forced and self.device_state[device]['ready_at'] is None:
+                self.scheduler.submit(TELEMETRY, self.trigger_bme_, device)
+            else:
+                self.scheduler.submit(TELEMETRY, self.read_bme_, device)
+        self.scheduler.submit(TELEMETRY, self.end_cycle_)
+        return 0
+
+    def read_current_(self, device):
+        data = self.get_current_sensor(device[1], device[2])
+        self.sweep_current.setdefault(device[1], {})[device[2]] = data
+        self.sampled_(device, data)
+        self.count_sweep_(device)
+
+    def count_sweep_(self, device):
+        # A cycle only reads the devices that are due, a sweep is complete once every
+        # channel was read since the previous one
+        if self.sweep_unread is not None:
+            self.sweep_unread.discard(device)
+            if self.sweep_unread:
+                return
+            self.sweeps += 1
+        self.sweep_unread = {key for key in self.devices_() if key[0] == 'current'}
+
+    def trigger_bme_(self, device):
+        # All due BMEs convert in parallel, they are collected in a later batch
+        state = self.device_state[device]
+        if self.trigger_bme_conversion_(device[1]):
+            state['ready_at'] = time.monotonic() + bme.conversion_time(self.sampling['bme']['oversampling'])
+        else:
+            self.sampled_(device, None)
+
+    def read_bme_(self, device):
+        self.device_state[device]['ready_at'] = None
+        data = self.get_bme_(device[1])
+        if data: self.sweep_bme[bme_slot(device[1])] = data
+        self.sampled_(device, data)
+
+    def sampled_(self, device, data):
+        kind = device[0]
+        config = self.sampling[kind]
+        state = self.device_state[device]
+        self.reads[kind] += 1
+        full = 1.0 / config['rate']
+        value = data.get(PRIMARY_FIELDS[kind]) if isinstance(data, dict) else None
+        # Failed reads come back as None, or -1 for the power monitors
+        state['failures'] = state['failures'] + 1 if value is None or (kind == 'current' and value == -1) else 0
+        if state['failures'] == MISSING_AFTER:
+            self.discovery.appendleft(('board', device[1]) if kind == 'current' else ('bme', device[1]))
         try:
-            self.bus.write_byte(address, value)
+            if not config['adaptive'] or value is None:
+                state['interval'] = full
+            elif (state['ref'] is None or abs(value - state['ref']) > config['change']
+                    or (config['limit'] is not None and value >= config['limit'])):
+                state['interval'] = full
+                state['ref'] = value
+            else:
+                state['interval'] = min(state['interval'] * 2, 1.0 / config['min_rate'])
+        finally:
+            # Keep the cadence, unless the loop fell behind by more than one interval.
+            # Also after a failed comparison, so a bad setting cannot spin the loop.
+            state['next_due'] = max(state['next_due'] + state['interval'], time.monotonic())
+
+    def end_cycle_(self):
+        if self.sweep_current or self.sweep_bme:
+            self.publish_sample_(self.sweep_current, self.sweep_bme)
+        self.cycles += 1
+        stats = self.bus.cycle_stats()
+        stats.update(self.scheduler.stats())
+        stats['cycles'] = self.cycles
+        stats['sweeps'] = self.sweeps
+        stats['cycle_time'] = time.monotonic() - self.cycle_start
+        stats['current_reads'] = self.reads['current']
+        stats['bme_reads'] = self.reads['bme']
+        stats['output_repairs'] = self.output_repairs
+        stats['pwm_moving'] = len(self.trajectories)
+        self.latency['sweep'].observe(stats['cycle_time'])
+        with self.telemetry.writing():
+            self.telemetry.write_stats(stats)
+            self.telemetry.write_histograms(self.latency)
+
+    def apply_command_(self, command, issued=None):
+        kind = command[0]
+        if issued is not None and kind in ACTUATION_COMMANDS:
+            self.latency['command_dispatch'].observe(time.monotonic() - issued)
+        self.recorder.record_command(time.time(), command)
+        if kind == 'switch':
+            self.switch_(command[1], command[2], command[3])
+        elif kind == 'pwm':
+            self.set_pwm_(command[1], command[2])
+        elif kind == 'pwm_freq':
+            self.set_pwm_freq_(command[1])
+        elif kind == 'batch':
+            self.apply_batch_(command[1])
+        elif kind == 'move':
+            self.start_moves_(command[1])
+        elif kind == 'rpi_pwm' and self.rpi_pwm_pins:
+            self.rpi_pwm_pins[command[1]].ChangeFrequency(command[2])
+        elif kind == 'sampling':
+            self.sampling[command[1]] = command[2]
+            # Restart the class at its full rate with the new settings
+            for device, state in self.device_state.items():
+                if device[0] == command[1]:
+                    state['interval'] = 1.0 / command[2]['rate']
+                    state['next_due'] = time.monotonic()
+                    state['ref'] = None
+                    state['ready_at'] = None
+            if command[1] == 'bme':
+                self.configure_bmes_()
+        elif kind == 'recording':
+            if command[1] is None:
+                self.recorder.stop()
+            else:
+                self.recorder.start(command[1])
+        if issued is not None and kind in ACTUATION_COMMANDS:
+            self.latency['command_apply'].observe(time.monotonic() - issued)
+
+    def apply_batch_(self, operations):
+        # The last value per output wins, every board gets a single register write
+        # and all PWM channels are set after one mux swap
+        stamp = time.time()
+        outputs = {}
+        pwms = {}
+        for op in operations:
+            self.recorder.record_command(stamp, op)
+            if op[0] == 'switch':
+                outputs.setdefault(op[1], {})[op[2]] = op[3]
+            elif op[0] == 'pwm':
+                pwms[op[1]] = op[2]
+        for board in sorted(outputs):
+            self.set_outputs_(board, outputs[board])
+        if pwms:
+            for channel in pwms:
+                self.trajectories.pop(channel, None)
+            self.set_pwms_(pwms)
+
+    def publish_sample_(self, current, bme):
+        # One timestamp per sweep, shared by the telemetry block and the recording
+        stamp = time.time()
+        with self.telemetry.writing():
+            for board in current:
+                for channel in current[board]:
+                    reading = current[board][channel]
+                    self.telemetry.write_current(board, channel, reading, stamp)
+                    if isinstance(reading, dict):
+                        self.recorder.record_current(stamp, board, channel, reading)
+            for slot in bme:
+                self.telemetry.write_bme(slot, bme[slot], stamp)
+                self.recorder.record_bme(stamp, slot, bme[slot])
+        self.sample_ready.set()
+
+    def start_discovery_(self):
+        # Every mux position, cached devices included, is probed once after startup
+        self.discovery.extend(('board', board) for board in range(4))
+        self.discovery.extend(('bme', (ch1, ch2)) for ch1 in range(2) for ch2 in range(8))
+
+    def submit_idle_job_(self):
+        # Low priority bus work, one job per idle gap so sampling is never held up
+        if self.discovery_state == 'ready':
+            self.queue_rediscovery_()
+        if self.discovery:
+            self.scheduler.submit(TELEMETRY, self.probe_, *self.discovery.popleft())
             return True
-        except:
-            return False
+        now = time.monotonic()
+        for board in self.boards:
+            if self.output_checks.get(board, 0) <= now:
+                self.output_checks[board] = now + OUTPUT_VERIFY_INTERVAL
+                self.scheduler.submit(TELEMETRY, self.verify_outputs_, board)
+                return True
+        return False
+
+    def queue_rediscovery_(self):
+        # Only the empty positions, a device in use is checked by its own reads
+        now = time.monotonic()
+        if self.discovery or now < self.next_rediscovery: return
+        self.next_rediscovery = now + REDISCOVERY_INTERVAL
+        self.discovery.extend(('board', board) for board in range(4) if board not in self.boards)
+        self.discovery.extend(('bme', (ch1, ch2)) for ch1 in range(2) for ch2 in range(8) if (ch1, ch2) not in self.bmes)
+
+    def probe_(self, kind, position):
+        changed = False
+        if kind == 'board':
+            present = self.probe_board_(position)
+            if present and position not in self.boards:
+                self.boards = sorted(self.boards + [position])
+                changed = True
+            elif not present and position in self.boards:
+                self.boards = [board for board in self.boards if board != position]
+                self.forget_device_(('current', position))
+                changed = True
+        else:
+            calibration = self.probe_bme_(position)
+            if calibration is not None:
+                changed = self.bmes.get(position) != calibration
+                self.bmes[position] = calibration
+                if changed: self.configure_bme_(position)
+            elif position in self.bmes:
+                del self.bmes[position]
+                self.forget_device_(('bme', position))
+                changed = True
+        if changed and self.discovery_state == 'ready':
+            print(f"Topology changed: boards {self.boards}, BMEs {sorted(bme_slot(key) for key in self.bmes)}")
+        if not self.discovery and self.discovery_state != 'ready':
+            self.discovery_state = 'ready'
+            self.next_rediscovery = time.monotonic() + REDISCOVERY_INTERVAL
+            changed = True
+        if changed:
+            save_topology(self.boards, self.bmes)
+            self.publish_topology_()
+
+    def forget_device_(self, device):
+        # Drops the sampling state and the last published readings of a missing device
+        with self.telemetry.writing():
+            if device[0] == 'current':
+                for channel in range(1, 5):
+                    self.device_state.pop(('current', device[1], channel), None)
+                    self.configured_sensors.discard((device[1], channel))
+                    if self.sweep_unread is not None:
+                        self.sweep_unread.discard(('current', device[1], channel))
+                self.telemetry.clear_current(device[1])
+            else:
+                self.device_state.pop(device, None)
+                self.telemetry.clear_bme(bme_slot(device[1]))
+
+    def publish_topology_(self):
+        with self.telemetry.writing():
+            self.telemetry.write_topology(DISCOVERY_STATES.index(self.discovery_state), self.boards,
+                                          [bme_slot(key) for key in self.bmes])
+
+    def swap_multiplexer_(self, num, channel):
+        # No bus traffic when the mux is already on that channel
+        return self.bus.select(num, channel)
     
-    def find_all_boards_(self):
-        address = 0b01000001
-        boards  = []
-        for i in range(4):
-            v = self.swap_multiplexer_(1, 2+i)
-            if not(v): continue
-            try:
-                self.bus.write_byte_data(address, 0x01, 0xF0)
-              #  time.sleep(1)
-                self.bus.write_byte_data(address, 0x03, 0xF0)
-               # time.sleep(1)
+    def probe_board_(self, board):
+        # The expander is set up the first time it is seen, with the outputs off or, for
+        # a board that comes back, as last requested. Later probes only read its
+        # configuration back.
+        address = EXPANDER_ADDRESS
+        if not self.swap_multiplexer_(1, 2+board): return False
+        try:
+            with self.bus.probing():
+                if board not in self.probed_boards:
+                    self.bus.write_byte_data(address, 0x01, self.outputs.get(board, 0xF0))
+                    self.bus.write_byte_data(address, 0x03, 0xF0)
                 status = self.bus.read_byte_data(address, 0x03)
-                #time.sleep(1)
-                if(status == 0xF0): boards.append(i)
-            except Exception as e:
-                print(e)
-        self.boards = boards
+        except Exception:
+            status = None
+        if status != 0xF0:
+            self.probed_boards.discard(board)
+            return False
+        if board not in self.probed_boards:
+            self.probed_boards.add(board)
+            self.outputs.setdefault(board, 0xF0)
+            self.output_checks[board] = 0
+            self.publish_outputs_(board)
+            # Power monitors are configured once here, not on every sample
+            for num in CURRENT_SENSOR_ADDRESSES:
+                try:
+                    self.configure_current_sensor_(board, num)
+                except Exception as e:
+                    print(f"Failed to configure current sensor {num} on board {board}: {e}")
+        return True
     
     def switch_(self, board, num, state):
-        address = 0b1000001
-        if(num<1 or num>4): return False
+        return self.set_outputs_(board, {num: state})
+
+    def set_outputs_(self, board, states):
+        # states: output number (1 to 4) -> on/off, all changed in one register write
+        # from the shadow copy, no read-modify-write
+        states = {num: state for num, state in states.items() if 1 <= num <= 4}
+        if not states: return False
+        # A cached board is set up before its first switch, not by a later probe
+        if(board in self.boards and board not in self.probed_boards):
+            self.probe_board_(board)
         if(board in self.boards):
-            v = self.swap_multiplexer_(1, 2+board)
-            if not(v): return False
-            try:
-                new_state = self.bus.read_byte_data(address, 0x01)
+            new_state = self.outputs.get(board, 0xF0)
+            for num, state in states.items():
                 mask = 1 << (num-1)
                 new_state &= 255-mask
                 if(state): new_state |= mask
-                self.bus.write_byte_data(address, 0x01, new_state)
-                new_state = self.bus.read_byte_data(address, 0x01)
+            if new_state == self.outputs.get(board):
                 return True
+            v = self.swap_multiplexer_(1, 2+board)
+            if not(v): return False
+            try:
+                self.bus.write_byte_data(EXPANDER_ADDRESS, 0x01, new_state)
             except:
                 return False
+            finally:
+                # Also a failed write, the readback repairs whatever the register holds
+                self.outputs[board] = new_state
+                self.output_checks[board] = min(self.output_checks.get(board, 0), time.monotonic() + 0.1)
+                self.publish_outputs_(board)
+            return True
+        return False
+
+    def verify_outputs_(self, board):
+        # Reads the pins and the direction register back, rewrites both if they differ
+        # from the shadow copy. A browned out expander comes back with every pin an input.
+        if board not in self.boards or not self.swap_multiplexer_(1, 2+board): return
+        requested = self.outputs.get(board, 0xF0)
+        try:
+            config = self.bus.read_byte_data(EXPANDER_ADDRESS, 0x03)
+            pins = self.bus.read_byte_data(EXPANDER_ADDRESS, 0x00)
+        except:
+            return
+        actual = pins & 0x0F if config & 0x0F == 0 else None
+        if config != 0xF0 or actual != requested & 0x0F:
+            self.output_repairs += 1
+            print(f"Repairing outputs of board {board}: pins 0x{pins:02x}, direction 0x{config:02x}, requested 0x{requested:02x}")
+            try:
+                self.bus.write_byte_data(EXPANDER_ADDRESS, 0x01, requested)
+                self.bus.write_byte_data(EXPANDER_ADDRESS, 0x03, 0xF0)
+            except:
+                pass
+            # Read back again at the next idle gap
+            self.output_checks[board] = 0
+        self.publish_outputs_(board, actual if actual is not None else 0, time.time())
+
+    def publish_outputs_(self, board, actual=None, stamp=None):
+        # actual None keeps the last readback
+        if actual is None:
+            actual, stamp = self.last_readback.get(board, (None, None))
+        else:
+            self.last_readback[board] = (actual, stamp)
+        with self.telemetry.writing():
+            self.telemetry.write_outputs(board, self.outputs.get(board), actual, stamp)
     
+    def configure_current_sensor_(self, board, num):
+        # Mux must already be on the board. Written once, and again after any failed read.
+        self.bus.write_byte_data(CURRENT_SENSOR_ADDRESSES[num], 0x0A, 0b111)
+        self.configured_sensors.add((board, num))
+
     def get_current_sensor(self, board, num):
-        if num ==1:  address = 0b1110000
-        elif num==2: address = 0b1110011
-        elif num==3: address = 0b1111100
-        elif num==4: address = 0b1111111
-        else: return {'current':-1, 'volt':-1,'watt': -1}
+        address = CURRENT_SENSOR_ADDRESSES.get(num)
+        if address is None: return {'current':-1, 'volt':-1,'watt': -1}
         if(board in self.boards):
             v = self.swap_multiplexer_(1, 2+board)
-            if not(v): return -1, -1, -1
+            if not(v): return {'current':-1, 'volt':-1,'watt': -1}
             try:
-                self.bus.write_byte_data(address, 0x0A, 0b111)
-                b1 = self.bus.read_i2c_block_data(address, 0x00, 2)
+                if (board, num) not in self.configured_sensors:
+                    self.configure_current_sensor_(board, num)
+                # Current (0x00) and voltage (0x02) in a single block read
+                b1 = self.bus.read_i2c_block_data(address, 0x00, 4)
                 a = 22*((b1[0]<<4) + (b1[1]>>4))/(4095)
-                b1 = self.bus.read_i2c_block_data(address, 0x02, 2)
-                v = 57.3*((b1[0]<<4) + (b1[1]>>4))/4095
-                b1 = self.bus.read_i2c_block_data(address, 0x08, 2)
-                # t = 0.48*((b1[0]<<1) + (b1[1]>>7)) Max sensor Temperature
+                v = 57.3*((b1[2]<<4) + (b1[3]>>4))/4095
                 w = a * v
                 if(v==0): a=0
                 return {'current':a, 'volt':v,'watt': w}
             except:
+                self.configured_sensors.discard((board, num))
                 return {'current':-1, 'volt':-1,'watt': -1}
     
     def get_all_current(self):
         retv = {}
-        for board in self.boards:
+        for board in sorted(self.boards):
             retv[board] = {}
             for i in range(1,5):
                 retv[board][i] = self.get_current_sensor(board,i)
         return retv
     
-    def find_all_bme_(self):
-        for ch1 in range(2):
-            self.swap_multiplexer_(1, ch1)
-            for ch2 in range(8):
-                self.swap_multiplexer_(2, ch2)
-                try:
-                    retv = bme280.load_calibration_params(self.bus, 0x76)
-                    if(retv): self.bmes[(ch1, ch2)] = retv
-                except:
-                    pass
+    def probe_bme_(self, key):
+        # Calibration is loaded once per probe and reused for every compensation
+        if not (self.swap_multiplexer_(1,key[0]) and self.swap_multiplexer_(2,key[1])): return None
+        try:
+            with self.bus.probing():
+                return bme.load_calibration(self.bus)
+        except:
+            return None
+
+    def configure_bmes_(self):
+        for key in sorted(self.bmes):
+            self.configure_bme_(key)
+
+    def configure_bme_(self, key):
+        config = self.sampling['bme']
+        if not (self.swap_multiplexer_(1,key[0]) and self.swap_multiplexer_(2,key[1])): return
+        try:
+            if config['mode'] == 'normal':
+                bme.set_normal_mode(self.bus, config['oversampling'], 1.0 / config['rate'])
+            else:
+                bme.set_sleep_mode(self.bus)
+        except Exception as e:
+            print(f"Failed to configure BME {bme_slot(key)}: {e}")
+
+    def trigger_bme_conversion_(self, key):
+        if not (self.swap_multiplexer_(1,key[0]) and self.swap_multiplexer_(2,key[1])): return False
+        try:
+            bme.trigger(self.bus, self.sampling['bme']['oversampling'])
+            return True
+        except:
+            return False
     
+    def get_bme_(self, key):
+        # Reads the last finished conversion
+        if not (self.swap_multiplexer_(1,key[0]) and self.swap_multiplexer_(2,key[1])): return None
+        try:
+            return bme.read(self.bus, self.bmes[key])
+        except:
+            return None
+
     def get_all_bme_(self):
         retv = {}
-        for key in self.bmes:
-            self.swap_multiplexer_(1,key[0])
-            self.swap_multiplexer_(2,key[1])
-            try:
-                data = bme280.sample(self.bus, 0x76, self.bmes[key])
-                retv[key[0]*8 + key[1]+1] = {'temperature':data.temperature, 'pressure':data.pressure, 'humidity':data.humidity}
-            except:
-                pass
+        # Sorted by mux path, so each primary channel is selected once per sweep
+        keys = sorted(self.bmes)
+        if self.sampling['bme']['mode'] == 'forced':
+            # Start every conversion first, then wait once for all of them
+            keys = [key for key in keys if self.trigger_bme_conversion_(key)]
+            time.sleep(bme.conversion_time(self.sampling['bme']['oversampling']))
+        for key in keys:
+            data = self.get_bme_(key)
+            if data: retv[bme_slot(key)] = data
         return retv
 
     def setup_pwm_chip_(self):
         if not(self.swap_multiplexer_(1, 6)): return False
         try:
-            self.pwm = PCA9685(busnum=self.i2c_bus)
+            pca9685.setup(self.bus)
+            self.pwm = True
+            # Off counts as written, setup turns every channel off
+            self.pwm_counts = [0] * pca9685.CHANNELS
             return True
         except:
+            self.pwm = None
             return False
     
     def set_pwm_freq_(self, freq=50):
         if not(self.swap_multiplexer_(1, 6)): return False
         if(self.pwm is None): return False
         try:
-            self.pwm.set_pwm_freq(freq)
+            pca9685.set_frequency(self.bus, freq)
             self.freq = freq
             return True
         except:
@@ -309,30 +804,107 @@ class Stack:
         if(per< 0 or per>100):return False
         val = int(4096*(0.0012 + per*0.000008)*self.freq)
         try:
-            self.pwm.set_all_pwm(0, val)
+            pca9685.write_all(self.bus, val)
+            self.pwm_counts = [val] * pca9685.CHANNELS
+            self.pwm_levels = dict.fromkeys(range(pca9685.CHANNELS), per)
+            self.trajectories.clear()
             return True
         except:
             return False
     
     def set_pwm_(self, channel, per):
-        if not(self.swap_multiplexer_(1, 6)): 
+        # A direct setpoint ends any move on the channel
+        self.trajectories.pop(channel, None)
+        return self.set_pwms_({channel: per})
+
+    def set_pwms_(self, channels):
+        # channels: PCA9685 channel -> percentage, after a single mux swap. The span from
+        # the lowest to the highest changed channel goes out in burst writes, channels
+        # in between are rewritten as they are.
+        if not(self.swap_multiplexer_(1, 6)) or self.pwm is None:
             print("Failed to set PWM: Multiplexer error")
             return False
-        if(per< 0 or per>100):
-            print("Failed to set PWM: Percentage out of range")
-            return False
-        val = int(4096*(0.0011 + per*0.000008)*self.freq)
+        invalid = sorted(channel for channel, per in channels.items()
+                         if not 0 <= channel < pca9685.CHANNELS or not 0 <= per <= 100)
+        if invalid:
+            print(f"Failed to set PWM: Channel or percentage out of range on {invalid}")
+        counts = list(self.pwm_counts)
+        for channel, per in channels.items():
+            if channel not in invalid:
+                counts[channel] = int(4096*(0.0011 + per*0.000008)*self.freq)
+                self.pwm_levels[channel] = per
+        changed = [channel for channel in range(pca9685.CHANNELS) if counts[channel] != self.pwm_counts[channel]]
+        if not changed: return not invalid
         try:
-            self.pwm.set_pwm(channel, 0, val)
-            print(f"Sent PWM to channel {channel} with duty cycle {per}%")
-            return True
+            pca9685.write_channels(self.bus, changed[0], counts[changed[0]:changed[-1] + 1])
+            self.pwm_counts = counts
         except:
             print("Failed to set PWM: Exception occurred")
             return False
-       
+        return not invalid
+
+    def start_moves_(self, moves):
+        # moves: (channel, target percentage, ramp time in s or None, velocity in %/s or None).
+        # All of them start on the same tick. A channel without a known position, or a
+        # move without ramp or velocity, goes to the target at once.
+        now = time.monotonic()
+        stamp = time.time()
+        immediate = {}
+        for channel, target, ramp, velocity in moves:
+            if not 0 <= channel < pca9685.CHANNELS or not 0 <= target <= 100:
+                print(f"Failed to move PWM channel {channel} to {target}%: out of range")
+                continue
+            start = self.pwm_level_(channel, now)
+            duration = 0
+            if start is not None:
+                duration = ramp if ramp else (abs(target - start) / velocity if velocity else 0)
+            self.recorder.record_command(stamp, ('pwm_move', channel, target, duration))
+            if duration > 0:
+                self.trajectories[channel] = (start, target, now, duration)
+            else:
+                self.trajectories.pop(channel, None)
+                immediate[channel] = target
+        if immediate:
+            self.set_pwms_(immediate)
+        if self.trajectories:
+            self.next_tick = min(self.next_tick, now)
+
+    def pwm_level_(self, channel, now):
+        # Where the channel is right now, None before its first setpoint
+        if channel in self.trajectories:
+            start, target, began, duration = self.trajectories[channel]
+            return start + (target - start) * min(1.0, (now - began) / duration)
+        return self.pwm_levels.get(channel)
+
+    def schedule_tick_(self, wait):
+        # Moves advance at a fixed rate, as actuation jobs ahead of pending reads.
+        # Returns how long the loop may sleep.
+        if not self.trajectories:
+            return wait
+        now = time.monotonic()
+        if now < self.next_tick:
+            return min(wait, self.next_tick - now)
+        # Keep the cadence, unless the loop fell behind by more than one tick
+        self.next_tick = max(self.next_tick + 1.0 / TRAJECTORY_RATE, now)
+        self.scheduler.submit(ACTUATION, self.trajectory_tick_)
+        return 0
+
+    def trajectory_tick_(self):
+        # Every moving channel in one burst, so coordinated moves land in the same frame
+        now = time.monotonic()
+        levels = {}
+        for channel in list(self.trajectories):
+            levels[channel] = self.pwm_level_(channel, now)
+            start, target, began, duration = self.trajectories[channel]
+            if now - began >= duration:
+                del self.trajectories[channel]
+        if levels:
+            self.set_pwms_(levels)
+
     def stop(self):
         self.flag.value = False
         self.proc.join()
+        self.telemetry.close(unlink=True)
 
 if __name__=="__main__":
     stack = Stack()
@@ -0,0 +1,454 @@
+"""Benchmark suite for the acquisition loop, the control path and the API.
+
+Runs against the simulated hardware in sim.py, so results only depend on the code
+and the machine:
+
+    cd app
+    python benchmark.py --out results.json --baseline benchmark_baseline.json
+    python benchmark.py --out benchmark_baseline.json    # record a new baseline
+
+Every benchmark runs --repeat times. A metric is stored as the median over the runs,
+with its interquartile range, unit and whether lower or higher is better. With
+--baseline the run is compared metric by metric, and the exit status is 1 when a
+median got worse by more than --tolerance plus the spread of both results. Results
+from another machine or with other parameters are not compared (exit status 2).
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Before anything imports hardware.py
+os.environ.setdefault('ASC_HARDWARE', 'sim')
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ('acquisition', 'joystick', 'sensor_data', 'fanout')
+
+
+def metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def quantile(buckets, counts, q):
+    # Linear interpolation inside the bucket holding the q-th observation, like Prometheus
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(tuple(buckets) + (buckets[-1],), counts):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return buckets[-1]
+
+
+def summarize(prefix, buckets, counts, total, count, unit='s'):
+    # Mean and percentiles of one histogram as metrics
+    if not count:
+        return {}
+    retv = {f'{prefix}_mean': metric(total / count, unit)}
+    for q in (0.5, 0.95, 0.99):
+        retv[f'{prefix}_p{int(q * 100)}'] = metric(quantile(buckets, counts, q), unit)
+    return retv
+
+
+def delta(after, before):
+    # Histogram observed between two read_histograms() snapshots
+    counts = [a - b for a, b in zip(after[0], before[0])]
+    return counts, after[1] - before[1], after[2] - before[2]
+
+
+# Acquisition loop, in process
+
+def bench_acquisition(args):
+    from Stack import Stack, BUS_JOBS
+    from metrics import LATENCY_BUCKETS
+    stack = Stack()
+    try:
+        # Let every device get its first read before measuring
+        time.sleep(args.warmup)
+        stats_before, latency_before = stack.get_bus_stats(), stack.get_latency()
+        time.sleep(args.duration)
+        stats, latency = stack.get_bus_stats(), stack.get_latency()
+    finally:
+        stack.stop()
+    # Per full sweep (every power monitor channel read once), not per cycle: how the
+    # due devices are split into cycles varies from run to run
+    sweeps = stats['sweeps'] - stats_before['sweeps']
+    if not sweeps:
+        return {}
+    retv = {'sweeps_per_s': metric(sweeps / args.duration, 'Hz', 'higher')}
+    bus_time = 0.0
+    for job in BUS_JOBS:
+        counts, total, count = delta(latency['job_' + job], latency_before['job_' + job])
+        bus_time += total
+        if count:
+            retv[f'job_{job}_mean'] = metric(total / count, 's')
+            retv[f'job_{job}_per_sweep'] = metric(total / sweeps, 's')
+    retv['bus_time_per_sweep'] = metric(bus_time / sweeps, 's')
+    transactions = stats['i2c_transactions'] - stats_before['i2c_transactions']
+    retv['i2c_transactions_per_sweep'] = metric(transactions / sweeps, 'transactions')
+    retv['i2c_errors'] = metric(stats['i2c_errors'] - stats_before['i2c_errors'], 'errors')
+    return retv
+
+
+# API benchmarks, against uvicorn in a child process
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    """The extension under uvicorn on a free local port, in the simulated vehicle.
+
+    Runs in its own process group with the acquisition process, so nothing outlives stop().
+    """
+
+    def __init__(self):
+        self.port = free_port()
+        code = f"import uvicorn, main; uvicorn.run(main.app, host='127.0.0.1', port={self.port}, log_level='warning')"
+        self.proc = subprocess.Popen([sys.executable, '-c', code], cwd=APP_DIR, start_new_session=True)
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = connection.getresponse()
+            return response.status, response.read().decode()
+        finally:
+            connection.close()
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.proc.returncode}")
+            try:
+                if self.request('GET', '/v1.0/bus_stats')[0] == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("Server did not come up")
+
+    def histograms(self, name):
+        # Parses one histogram family from /metrics: labels -> (buckets, counts, sum, count)
+        retv = {}
+        for line in self.request('GET', '/metrics')[1].splitlines():
+            match = re.match(rf'{name}_(bucket|sum|count)(?:{{(.*)}})? (\S+)$', line)
+            if not match:
+                continue
+            kind, labels, value = match.groups()
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', labels or ''))
+            bound = labels.pop('le', None)
+            entry = retv.setdefault(tuple(sorted(labels.items())), [[], [], 0.0, 0])
+            if kind == 'bucket':
+                if bound != '+Inf':
+                    entry[0].append(float(bound))
+                entry[1].append(int(value))
+            elif kind == 'sum':
+                entry[2] = float(value)
+            else:
+                entry[3] = int(value)
+        for entry in retv.values():
+            # Cumulative bucket counts to per-bucket counts
+            entry[1] = [count - previous for count, previous in zip(entry[1], [0] + entry[1][:-1])]
+        return retv
+
+    def stop(self):
+        # uvicorn shuts the acquisition process down on SIGTERM, whatever is left is killed
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            pass
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+
+
+def joystick_json(sequence, speed, sent=None):
+    # Alternating direction, so every frame is a new motor setpoint. 't' is ignored by
+    # the server and echoed unchanged to JSON clients.
+    value = speed if sequence % 2 else -speed
+    frame = {'axes': [{'index': 1, 'value': value}, {'index': 2, 'value': 0.0}], 'buttons': []}
+    if sent is not None:
+        frame['t'] = sent
+    return json.dumps(frame)
+
+
+async def pace(rate, duration, send):
+    # Calls send(sequence) rate times a second, without drift
+    interval = 1.0 / rate
+    start = time.monotonic()
+    sequence = 0
+    while time.monotonic() - start < duration:
+        await send(sequence)
+        sequence += 1
+        await asyncio.sleep(max(0.0, start + sequence * interval - time.monotonic()))
+    return sequence
+
+
+def bench_joystick(server, args):
+    import websockets
+    from metrics import LATENCY_BUCKETS
+    server.request('POST', '/v1.0/start_motion')
+    before = server.histograms('asc_joystick_latency_seconds')
+
+    async def run():
+        async with websockets.connect(f'ws://127.0.0.1:{server.port}/ws/joystick') as pilot:
+            async def send(sequence):
+                await pilot.send(joystick_json(sequence, 0.8))
+                # Drain our own echoes
+                while True:
+                    try:
+                        await asyncio.wait_for(pilot.recv(), 0)
+                    except asyncio.TimeoutError:
+                        return
+            return await pace(args.rate, args.duration, send)
+
+    asyncio.run(run())
+    # Let the last frames reach the serial writers
+    time.sleep(0.5)
+    after = server.histograms('asc_joystick_latency_seconds')
+    server.request('POST', '/v1.0/stop_motion')
+    retv = {}
+    for labels, histogram in after.items():
+        stage = dict(labels).get('stage')
+        counts, total, count = histogram[1:]
+        if labels in before:
+            counts, total, count = delta(histogram[1:], before[labels][1:])
+        if stage == 'serial_write':
+            stage += '_' + dict(labels).get('motor', '')
+        retv.update(summarize(f'{stage}_latency', LATENCY_BUCKETS, counts, total, count))
+    return retv
+
+
+def bench_sensor_data(server, args):
+    path = '/v1.0/sensor_data'
+    deadline = time.monotonic() + args.duration
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        # One keep-alive connection per client, like a polling dashboard
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        requests, errors, elapsed = 0, 0, []
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors += 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            requests += 1
+            elapsed.append(time.monotonic() - start)
+        connection.close()
+        with lock:
+            results.append((requests, errors, elapsed))
+
+    threads = [threading.Thread(target=client) for _ in range(args.http_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    requests = sum(result[0] for result in results)
+    elapsed = sorted(value for result in results for value in result[2])
+    retv = {
+        'requests_per_s': metric(requests / args.duration, 'req/s', 'higher'),
+        'errors': metric(sum(result[1] for result in results), 'requests'),
+    }
+    if elapsed:
+        retv['latency_mean'] = metric(sum(elapsed) / len(elapsed), 's')
+        for q in (0.5, 0.95, 0.99):
+            retv[f'latency_p{int(q * 100)}'] = metric(elapsed[min(len(elapsed) - 1, int(q * len(elapsed)))], 's')
+    return retv
+
+
+def bench_fanout(server, args):
+    import websockets
+    url = f'ws://127.0.0.1:{server.port}/ws/joystick'
+    delays = []
+    received = [0] * args.clients
+
+    async def viewer(index, stop):
+        async with websockets.connect(url) as websocket:
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), 0.2)
+                except asyncio.TimeoutError:
+                    continue
+                sent = json.loads(message).get('t')
+                if sent is not None:
+                    delays.append(time.monotonic() - sent)
+                    received[index] += 1
+
+    async def run():
+        stop = asyncio.Event()
+        viewers = [asyncio.create_task(viewer(index, stop)) for index in range(args.clients)]
+        # Give every viewer time to connect
+        await asyncio.sleep(0.5)
+        async with websockets.connect(url) as pilot:
+            frames = await pace(args.rate, args.duration,
+                                lambda sequence: pilot.send(joystick_json(sequence, 0.0, time.monotonic())))
+            await asyncio.sleep(0.5)
+        stop.set()
+        await asyncio.gather(*viewers)
+        return frames
+
+    frames = asyncio.run(run())
+    delays.sort()
+    retv = {'delivery_ratio': metric(sum(received) / max(frames * args.clients, 1), 'ratio', 'higher')}
+    if delays:
+        retv['delay_mean'] = metric(sum(delays) / len(delays), 's')
+        for q in (0.5, 0.95, 0.99):
+            retv[f'delay_p{int(q * 100)}'] = metric(delays[min(len(delays) - 1, int(q * len(delays)))], 's')
+    return retv
+
+
+# Results
+
+def aggregate(runs):
+    # Median and interquartile range of every metric over the repeated runs
+    retv = {}
+    for key in dict.fromkeys(key for run in runs for key in run):
+        values = sorted(run[key]['value'] for run in runs if key in run and run[key]['value'] is not None)
+        first = next(run[key] for run in runs if key in run)
+        entry = metric(statistics.median(values) if values else None, first['unit'], first['better'])
+        if len(values) > 1:
+            quartiles = statistics.quantiles(values, n=4, method='inclusive')
+            entry['iqr'] = quartiles[2] - quartiles[0]
+        entry['runs'] = len(values)
+        retv[key] = entry
+    return retv
+
+
+def mismatches(results, baseline):
+    # Settings that make two results incomparable
+    retv = []
+    for section in ('machine', 'hardware', 'sim', 'parameters'):
+        if results.get(section) != baseline.get(section):
+            retv.append((section, baseline.get(section), results.get(section)))
+    return retv
+
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions as (benchmark, metric, baseline value, value, change). A
+    # median only regresses when it moved by more than the tolerance plus the spread
+    # of both results, so run to run noise does not count.
+    regressions = []
+    for name, metrics in results['benchmarks'].items():
+        for key, current in metrics.items():
+            previous = baseline.get('benchmarks', {}).get(name, {}).get(key)
+            if previous is None or previous['value'] is None or current['value'] is None:
+                continue
+            allowed = tolerance * abs(previous['value']) + previous.get('iqr', 0.0) + current.get('iqr', 0.0)
+            difference = current['value'] - previous['value']
+            worse = difference > allowed if current['better'] == 'lower' else -difference > allowed
+            if previous['value'] == 0:
+                change = 0.0 if current['value'] == 0 else float('inf')
+            else:
+                change = difference / abs(previous['value'])
+            if worse:
+                regressions.append((name, key, previous['value'], current['value'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, help='Run only this benchmark, repeatable')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark, metrics are the median over them')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds measured per benchmark')
+    parser.add_argument('--warmup', type=float, default=2.0, help='Seconds before the acquisition loop is measured')
+    parser.add_argument('--rate', type=float, default=60.0, help='Joystick frames per second')
+    parser.add_argument('--clients', type=int, default=10, help='WebSocket clients in the fan-out benchmark')
+    parser.add_argument('--http-clients', type=int, default=4, help='Concurrent clients polling /sensor_data')
+    parser.add_argument('--out', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative change, on top of the spread of the runs, before a metric counts as a regression')
+    args = parser.parse_args()
+    selected = args.only or BENCHMARKS
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'hardware': os.environ['ASC_HARDWARE'],
+        'sim': {key: value for key, value in sorted(os.environ.items()) if key.startswith('ASC_SIM_')},
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('out', 'baseline', 'only', 'tolerance')},
+        'benchmarks': {},
+    }
+    # Checked before spending minutes on the runs
+    if baseline is not None and mismatches(results, baseline):
+        for section, previous, current in mismatches(results, baseline):
+            print(f"Not comparable, {section} does not match: baseline {previous}, this run {current}")
+        sys.exit(2)
+
+    runs = {name: [] for name in selected}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Recordings and the topology cache stay out of /root/.config/asc
+        os.environ['ASC_RECORD_DIR'] = os.path.join(work_dir, 'recordings')
+        os.environ['ASC_TOPOLOGY_CACHE'] = os.path.join(work_dir, 'topology.json')
+        if 'acquisition' in selected:
+            for run in range(args.repeat):
+                print(f"Benchmarking the acquisition loop ({run + 1}/{args.repeat})")
+                runs['acquisition'].append(bench_acquisition(args))
+        api = [name for name in selected if name != 'acquisition']
+        if api:
+            server = Server()
+            try:
+                server.wait_ready()
+                for run in range(args.repeat):
+                    for name in api:
+                        print(f"Benchmarking {name} ({run + 1}/{args.repeat})")
+                        runs[name].append(globals()[f'bench_{name}'](server, args))
+            finally:
+                server.stop()
+    for name in selected:
+        results['benchmarks'][name] = aggregate(runs[name])
+
+    for name, metrics in results['benchmarks'].items():
+        for key, value in metrics.items():
+            spread = f" (IQR {value['iqr']:.3g})" if 'iqr' in value else ''
+            print(f"  {name}.{key}: {value['value']:.6g} {value['unit']}{spread}" if value['value'] is not None else f"  {name}.{key}: -")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, previous, current, change in regressions:
+            print(f"REGRESSION {name}.{key}: {previous:.6g} -> {current:.6g} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
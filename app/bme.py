@@ -0,0 +1,110 @@
+import struct
+from collections import namedtuple
+
+# BME280 driver split into trigger and read, so many sensors can convert at the same time
+BME_ADDRESS = 0x76
+CHIP_ID = 0x60
+
+_REG_ID = 0xD0
+_REG_CTRL_HUM = 0xF2
+_REG_CTRL_MEAS = 0xF4
+_REG_CONFIG = 0xF5
+_REG_DATA = 0xF7
+
+_MODE_SLEEP = 0b00
+_MODE_FORCED = 0b01
+_MODE_NORMAL = 0b11
+
+# Oversampling (number of samples) to its register code
+OVERSAMPLING = {1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+# Normal mode standby times in ms to their register code
+_STANDBY = {0.5: 0, 10: 6, 20: 7, 62.5: 1, 125: 2, 250: 3, 500: 4, 1000: 5}
+
+Calibration = namedtuple('Calibration', [
+    'T1', 'T2', 'T3',
+    'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9',
+    'H1', 'H2', 'H3', 'H4', 'H5', 'H6',
+])
+
+
+def _signed8(value):
+    return value - 256 if value > 127 else value
+
+
+def load_calibration(bus, address=BME_ADDRESS):
+    # Raises if there is no BME280 at this address
+    if bus.read_byte_data(address, _REG_ID) != CHIP_ID:
+        raise IOError(f"No BME280 at 0x{address:02x}")
+    block = bytes(bus.read_i2c_block_data(address, 0x88, 24))
+    t_p = struct.unpack('<HhhHhhhhhhhh', block)
+    h1 = bus.read_byte_data(address, 0xA1)
+    b = bus.read_i2c_block_data(address, 0xE1, 7)
+    h2 = struct.unpack('<h', bytes(b[0:2]))[0]
+    h4 = (_signed8(b[3]) << 4) | (b[4] & 0x0F)
+    h5 = (_signed8(b[5]) << 4) | (b[4] >> 4)
+    return Calibration(*t_p, h1, h2, b[2], h4, h5, _signed8(b[6]))
+
+
+def conversion_time(oversampling=1):
+    # Worst case duration of one forced measurement in seconds (datasheet, section 9.1)
+    return (1.25 + 2.3 * oversampling + (2.3 * oversampling + 0.575) * 2) / 1000.0
+
+
+def trigger(bus, oversampling=1, address=BME_ADDRESS):
+    # Starts one forced measurement, the result is ready after conversion_time()
+    code = OVERSAMPLING[oversampling]
+    bus.write_byte_data(address, _REG_CTRL_HUM, code)
+    bus.write_byte_data(address, _REG_CTRL_MEAS, code << 5 | code << 2 | _MODE_FORCED)
+
+
+def set_normal_mode(bus, oversampling=1, period=1.0, address=BME_ADDRESS):
+    # Free running: the sensor measures on its own, with a standby time that fits the period
+    code = OVERSAMPLING[oversampling]
+    standby = max([t for t in _STANDBY if t / 1000.0 <= period] or [0.5])
+    bus.write_byte_data(address, _REG_CTRL_MEAS, _MODE_SLEEP)
+    bus.write_byte_data(address, _REG_CONFIG, _STANDBY[standby] << 5)
+    bus.write_byte_data(address, _REG_CTRL_HUM, code)
+    bus.write_byte_data(address, _REG_CTRL_MEAS, code << 5 | code << 2 | _MODE_NORMAL)
+
+
+def set_sleep_mode(bus, address=BME_ADDRESS):
+    bus.write_byte_data(address, _REG_CTRL_MEAS, _MODE_SLEEP)
+
+
+def read(bus, calibration, address=BME_ADDRESS):
+    d = bus.read_i2c_block_data(address, _REG_DATA, 8)
+    adc_p = (d[0] << 12) | (d[1] << 4) | (d[2] >> 4)
+    adc_t = (d[3] << 12) | (d[4] << 4) | (d[5] >> 4)
+    adc_h = (d[6] << 8) | d[7]
+    return compensate(calibration, adc_t, adc_p, adc_h)
+
+
+def compensate(c, adc_t, adc_p, adc_h):
+    # Floating point compensation from the BME280 datasheet, section 8.1
+    var1 = (adc_t / 16384.0 - c.T1 / 1024.0) * c.T2
+    var2 = (adc_t / 131072.0 - c.T1 / 8192.0) ** 2 * c.T3
+    t_fine = var1 + var2
+    temperature = t_fine / 5120.0
+
+    var1 = t_fine / 2.0 - 64000.0
+    var2 = var1 * var1 * c.P6 / 32768.0
+    var2 = var2 + var1 * c.P5 * 2.0
+    var2 = var2 / 4.0 + c.P4 * 65536.0
+    var1 = (c.P3 * var1 * var1 / 524288.0 + c.P2 * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * c.P1
+    if var1 == 0:
+        pressure = 0.0
+    else:
+        p = 1048576.0 - adc_p
+        p = ((p - var2 / 4096.0) * 6250.0) / var1
+        var1 = c.P9 * p * p / 2147483648.0
+        var2 = p * c.P8 / 32768.0
+        pressure = (p + (var1 + var2 + c.P7) / 16.0) / 100.0
+
+    h = t_fine - 76800.0
+    h = (adc_h - (c.H4 * 64.0 + c.H5 / 16384.0 * h)) * (
+        c.H2 / 65536.0 * (1.0 + c.H6 / 67108864.0 * h * (1.0 + c.H3 / 67108864.0 * h)))
+    h = h * (1.0 - c.H1 * h / 524288.0)
+    humidity = min(max(h, 0.0), 100.0)
+
+    return {'temperature': temperature, 'pressure': pressure, 'humidity': humidity}
@@ -0,0 +1,17 @@
+import os
+
+# Device layer: 'vehicle' uses the real buses and ports, 'sim' the simulated ones in
+# sim.py, so the whole extension runs on any Linux box.
+HARDWARE = os.environ.get('ASC_HARDWARE', 'vehicle')
+SIMULATED = HARDWARE == 'sim'
+
+if SIMULATED:
+    from sim import SMBus, GPIO, Serial
+    # Simulated Arduinos are ready as soon as the port is open
+    SERIAL_RESET_TIME = 0.0
+else:
+    import RPi.GPIO as GPIO
+    from smbus import SMBus
+    from serial import Serial
+    # Arduinos reset when the port is opened and take about this long to boot
+    SERIAL_RESET_TIME = 2.0
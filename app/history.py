@@ -0,0 +1,167 @@
+import threading
+import time
+import numpy as np
+
+# Raw samples kept per channel, about 80 s of current readings at 50 Hz
+RAW_SIZE = 4096
+# Rolled-up tiers: (name, bucket length in seconds, number of buckets kept)
+TIERS = (('1s', 1, 3600), ('10s', 10, 2160), ('1m', 60, 1440))
+RESOLUTIONS = ('raw',) + tuple(name for name, _, _ in TIERS)
+
+CHANNEL_FIELDS = {'current': ('current', 'volt', 'watt'), 'bme': ('temperature', 'pressure', 'humidity')}
+
+
+class Ring:
+    """Fixed-size ring of float64 rows, column 0 is the time."""
+
+    def __init__(self, size, width):
+        self.rows = np.zeros((size, width))
+        self.head = 0
+        self.count = 0
+
+    def append(self, row):
+        self.rows[self.head] = row
+        self.head = (self.head + 1) % len(self.rows)
+        self.count = min(self.count + 1, len(self.rows))
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.rows[(self.head - self.count) % len(self.rows), 0]
+
+    def covers(self, start):
+        # True when nothing newer than start has been overwritten yet
+        return self.count < len(self.rows) or self.oldest() <= start
+
+    def since(self, start):
+        # Rows with time >= start, oldest first
+        if not self.count:
+            return self.rows[:0]
+        index = (np.arange(self.head - self.count, self.head)) % len(self.rows)
+        rows = self.rows[index]
+        return rows[rows[:, 0] >= start]
+
+
+class Rollup:
+    """Min/max/mean buckets of a fixed length, the open bucket is flushed when time moves past it."""
+
+    def __init__(self, period, size, width):
+        self.period = period
+        self.ring = Ring(size, 1 + 3 * width)
+        self.start = None
+        self.low = self.high = self.total = None
+        self.n = 0
+
+    def add(self, stamp, values):
+        bucket = stamp - stamp % self.period
+        if self.start is not None and bucket != self.start:
+            self.flush_()
+        if self.n == 0:
+            self.start = bucket
+            self.low = values.copy()
+            self.high = values.copy()
+            self.total = values.copy()
+        else:
+            np.minimum(self.low, values, out=self.low)
+            np.maximum(self.high, values, out=self.high)
+            self.total += values
+        self.n += 1
+
+    def flush_(self):
+        if self.n:
+            self.ring.append(np.concatenate(([self.start], self.low, self.high, self.total / self.n)))
+        self.n = 0
+        self.start = None
+
+    def since(self, start):
+        rows = self.ring.since(start)
+        if self.n and self.start >= start:
+            # Include the bucket that is still filling
+            rows = np.vstack([rows, np.concatenate(([self.start], self.low, self.high, self.total / self.n))])
+        return rows
+
+
+class ChannelHistory:
+    def __init__(self, fields):
+        self.fields = fields
+        self.last = 0.0
+        self.raw = Ring(RAW_SIZE, 1 + len(fields))
+        self.tiers = {name: Rollup(period, size, len(fields)) for name, period, size in TIERS}
+
+    def add(self, stamp, values):
+        values = np.asarray(values, dtype=float)
+        self.raw.append(np.concatenate(([stamp], values)))
+        for tier in self.tiers.values():
+            tier.add(stamp, values)
+        self.last = stamp
+
+
+class TelemetryHistory:
+    """Every telemetry sample, per channel, in NumPy ring buffers with rolled-up tiers.
+
+    Channels are named like the telemetry paths, "current/<board>/<channel>" and
+    "bme/<slot>". Memory is bounded: raw samples plus 1 s, 10 s and 1 min buckets.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def record(self, sample):
+        # Readings carry their own sample time, a reading is only stored once
+        with self.lock:
+            for board, channels in sample.get('current', {}).items():
+                for channel, reading in channels.items():
+                    self.add_(f'current/{board}/{channel}', 'current', reading)
+            for slot, reading in sample.get('bme', {}).items():
+                self.add_(f'bme/{slot}', 'bme', reading)
+
+    def add_(self, name, kind, reading):
+        stamp = reading.get('time', 0)
+        fields = CHANNEL_FIELDS[kind]
+        values = [reading[field] for field in fields]
+        if kind == 'current' and all(value == -1 for value in values):
+            return  # Failed read
+        history = self.channels.get(name)
+        if history is None:
+            history = self.channels[name] = ChannelHistory(fields)
+        if stamp > history.last:
+            history.add(stamp, values)
+
+    def list_channels(self):
+        with self.lock:
+            return sorted(self.channels)
+
+    def query(self, name, window=600.0, resolution='auto'):
+        """Samples of one channel over the last `window` seconds as column arrays.
+
+        'auto' picks the finest resolution that still covers the window.
+        Raises KeyError for an unknown channel and ValueError for a bad resolution.
+        """
+        if resolution != 'auto' and resolution not in RESOLUTIONS:
+            raise ValueError(f"Resolution must be one of {('auto',) + RESOLUTIONS}")
+        with self.lock:
+            history = self.channels[name]
+            start = time.time() - window
+            if resolution == 'auto':
+                rings = [('raw', history.raw)] + [(tier, rollup.ring) for tier, rollup in history.tiers.items()]
+                resolution = next((tier for tier, ring in rings if ring.covers(start)), TIERS[-1][0])
+            if resolution == 'raw':
+                rows = history.raw.since(start)
+            else:
+                rows = history.tiers[resolution].since(start)
+        retv = {'channel': name, 'resolution': resolution, 'time': rows[:, 0].tolist()}
+        width = len(history.fields)
+        for index, field in enumerate(history.fields):
+            if resolution == 'raw':
+                retv[field] = rows[:, 1 + index].tolist()
+            else:
+                retv[field] = {
+                    'min': rows[:, 1 + index].tolist(),
+                    'max': rows[:, 1 + width + index].tolist(),
+                    'mean': rows[:, 1 + 2 * width + index].tolist(),
+                }
+        return retv
+
+
+telemetry_history = TelemetryHistory()
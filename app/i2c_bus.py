@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+
+# TCA9548A multiplexer addresses, by the mux number used throughout Stack
+MUX_ADDRESSES = {1: 0x77, 2: 0x71}
+
+
+class MuxBus:
+    """SMBus wrapper that remembers which channel every multiplexer is on.
+
+    Selecting the channel a mux is already on costs no bus traffic. The secondary
+    mux sits behind a primary channel, so its state is remembered per primary
+    channel. Any failed transaction forgets everything, since a mux that browned
+    out comes back with all channels off.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.state = {}
+        self.swaps = 0
+        self.swaps_skipped = 0
+        self.errors = 0
+        self.transactions = 0
+        # Set while probing for devices that may not be there
+        self.probing_ = False
+
+    def key_(self, num):
+        if num == 1:
+            return 1
+        return (num, self.state.get(1))
+
+    def select(self, num, channel):
+        address = MUX_ADDRESSES.get(num)
+        if address is None or channel < 0 or channel > 7:
+            return False
+        key = self.key_(num)
+        if self.state.get(key) == channel:
+            self.swaps_skipped += 1
+            return True
+        self.transactions += 1
+        try:
+            self.bus.write_byte(address, 1 << channel)
+        except Exception:
+            self.errors += 1
+            self.invalidate()
+            return False
+        self.state[key] = channel
+        self.swaps += 1
+        return True
+
+    @contextmanager
+    def probing(self):
+        # A missing device answering with a NACK is expected, not counted as an error
+        self.probing_ = True
+        try:
+            yield self
+        finally:
+            self.probing_ = False
+
+    def invalidate(self):
+        self.state.clear()
+
+    def cycle_stats(self):
+        # Swap counters since the previous call, transactions and failed ones since the start
+        retv = {'mux_swaps': self.swaps, 'mux_swaps_skipped': self.swaps_skipped,
+                'i2c_transactions': self.transactions, 'i2c_errors': self.errors}
+        self.swaps = 0
+        self.swaps_skipped = 0
+        return retv
+
+    def __getattr__(self, name):
+        # Everything else goes straight to the SMBus object
+        attr = getattr(self.bus, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.transactions += 1
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                if not self.probing_:
+                    self.errors += 1
+                self.invalidate()
+                raise
+        self.__dict__[name] = call
+        return call
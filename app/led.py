@@ -1,37 +1,89 @@
-import serial
 import threading
-import queue
+import time
+import serial_link
+import hardware
 
 # Configuration
 LED_NANO_PORT = '/dev/LEDS'   # Update to your actual port
 BAUD_RATE = 9600
-
-# Thread-safe command queue
-command_queue = queue.Queue()
+# At most this many writes per second, each one carries every channel that changed
+LED_FLUSH_RATE = 20.0
+# Brightness channels on the LED Nano
+LED_CHANNELS = 4
 
 class LEDController:
     def __init__(self):
+        # Track switch states and brightness values
+        self.switch_states = {index: False for index in range(LED_CHANNELS)}
+        self.brightness_values = {index: 0 for index in range(LED_CHANNELS)}
+        # 'binary' frames or 'ascii' lines, agreed on when the port is opened
+        self.protocol = 'ascii'
+        # Set once the port is open and the protocol agreed on, in the background
+        self.ready = False
+        # Latest brightness waiting to be sent, per channel
+        self.pending = {}
+        self.sent = {}
+        self.condition = threading.Condition()
+        self.posted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.writes = 0
+        self.bytes_written = 0
         self.serial_thread = threading.Thread(target=self.serial_worker, daemon=True)
         self.serial_thread.start()
-        # Track switch states and brightness values
-        self.switch_states = {0: False, 1: False, 2: False, 3: False}
-        self.brightness_values = {0: 0, 1: 0, 2: 0, 3: 0}
     
     def serial_worker(self):
         try:
-            with serial.Serial(LED_NANO_PORT, BAUD_RATE, timeout=1) as led_serial:
-                print("LED Nano serial port initialized.")
+            with hardware.Serial(LED_NANO_PORT, BAUD_RATE, timeout=0.1) as led_serial:
+                # Wait for the Arduino to be ready, it resets when the port is opened
+                time.sleep(hardware.SERIAL_RESET_TIME)
+                self.protocol = serial_link.handshake(led_serial)
+                print(f"LED Nano serial port initialized ({self.protocol} at {led_serial.baudrate} baud).")
+                self.ready = True
                 while True:
-                    command = command_queue.get()
-                    if command is None:
-                        break
+                    with self.condition:
+                        while not self.pending:
+                            self.condition.wait()
+                        batch, self.pending = self.pending, {}
+                    # Channels already at the requested value are not sent again
+                    changes = [(index, value) for index, value in sorted(batch.items()) if self.sent.get(index) != value]
+                    self.dropped += len(batch) - len(changes)
+                    if not changes:
+                        continue
+                    data = b''
                     try:
-                        led_serial.write(command.encode())
+                        if self.protocol == 'binary':
+                            data = b''.join(serial_link.encode_brightness(index, value) for index, value in changes)
+                        else:
+                            data = ''.join(f"BRIGHTNESS:{index}:{value}\n" for index, value in changes).encode()
+                        led_serial.write(data)
+                        self.sent.update(changes)
+                        self.writes += 1
+                        self.bytes_written += len(data)
                     except Exception as e:
                         print(f"Serial communication error: {e}")
+                        # Retried with the next flush, unless a newer value was posted meanwhile
+                        with self.condition:
+                            for index, value in changes:
+                                self.pending.setdefault(index, value)
+                    # Never faster than the link drains (10 bits per byte), nor than LED_FLUSH_RATE.
+                    # Updates arriving meanwhile are coalesced.
+                    time.sleep(max(1.0 / LED_FLUSH_RATE, len(data) * 10.0 / led_serial.baudrate))
         except Exception as e:
             print(f"Error initializing serial port: {e}")
 
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.pending),
+                'posted': self.posted,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'writes': self.writes,
+                'bytes': self.bytes_written,
+                'protocol': self.protocol,
+            }
+
     def set_switch_state(self, index, state):
         # Store the switch state (True for ON, False for OFF)
         self.switch_states[index] = bool(state)
@@ -41,18 +93,30 @@ class LEDController:
         # Return switch state (default to False if not found)
         return self.switch_states.get(index, False)
     
+    def valid_channel(self, index):
+        return index in self.brightness_values
+
     def get_brightness(self, index):
         # Return current brightness (default to 0 if not found)
         return self.brightness_values.get(index, 0)
 
     def set_brightness(self, index, brightness):
-        # Clamp brightness to 0-100 range
-        brightness = max(0, min(100, brightness))
+        self.set_brightnesses({index: brightness})
+
+    def set_brightnesses(self, values):
+        # index -> brightness, posted together so they go out in the same serial write
+        # Unknown channels are ignored, clamp brightness to 0-100 range
+        values = {index: max(0, min(100, brightness)) for index, brightness in values.items() if self.valid_channel(index)}
         # Store the brightness value
-        self.brightness_values[index] = brightness
-        # Generate command and send to Arduino
-        command = f"BRIGHTNESS:{index}:{brightness}\n"
-        command_queue.put(command)
+        self.brightness_values.update(values)
+        # Only the latest value per channel is kept until the serial worker sends it
+        with self.condition:
+            for index, brightness in values.items():
+                if index in self.pending:
+                    self.coalesced += 1
+                self.pending[index] = brightness
+                self.posted += 1
+            self.condition.notify()
 
 # Global instance
 led_controller = LEDController()
\ No newline at end of file
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from metrics import metrics
+
+# Event loop stall detection, on in debug mode (ASC_DEBUG=1). A heartbeat task on the
+# loop measures how late it wakes up, and a watchdog thread reports a stall while it is
+# still going on, with the stack of the loop thread, so the blocking call is named.
+DEBUG = os.environ.get('ASC_DEBUG') == '1'
+STALL_THRESHOLD = float(os.environ.get('ASC_STALL_THRESHOLD', 0.1))
+
+
+class StallMonitor:
+    def __init__(self, threshold=STALL_THRESHOLD, report=print):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.report = report
+        self.lag = metrics.histogram('asc_event_loop_lag_seconds', 'How late the event loop heartbeat woke up')
+        self.stalls = 0
+        self.worst = 0.0
+        self.beat = time.monotonic()
+        self.reported = False
+        self.thread_id = None
+
+    def start(self, loop):
+        # Called on the loop thread
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        loop.create_task(self.heartbeat_())
+        threading.Thread(target=self.watch_, daemon=True).start()
+
+    async def heartbeat_(self):
+        while True:
+            due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - due)
+            self.lag.observe(lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                self.worst = max(self.worst, lag)
+                self.report(f"Event loop stalled for {lag:.3f} s")
+            self.beat = now
+            self.reported = False
+
+    def watch_(self):
+        while True:
+            time.sleep(self.interval)
+            stalled = time.monotonic() - self.beat - self.interval
+            if stalled > self.threshold and not self.reported:
+                self.reported = True
+                frame = sys._current_frames().get(self.thread_id)
+                where = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                self.report(f"Event loop blocked for {stalled:.3f} s so far, in:\n{where}")
+
+    def stats(self):
+        return {'stalls': self.stalls, 'worst': self.worst, 'threshold': self.threshold}
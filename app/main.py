@@ -4,12 +4,16 @@ import uvicorn
 import threading
 import json
 import time
-from fastapi import FastAPI, status, WebSocket, WebSocketDisconnect
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Response, status, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse
 from fastapi_versioning import VersionedFastAPI, version
 from loguru import logger
 from pydantic import BaseModel
+from typing import List
 from Stack import Stack
 import subprocess
 import os
@@ -17,6 +21,13 @@ import socket
 
 # Import LED Controller
 from led import led_controller
+from telemetry import telemetry_hub
+from history import telemetry_history
+from recorder import RecordingReader, ReplaySource, list_sessions
+from metrics import metrics, LATENCY_BUCKETS
+from loop_monitor import DEBUG, StallMonitor
+import pca9685
+import telemetry_block
 
 # Service name for logging
 SERVICE_NAME = "RealTimeSensorDisplay"
@@ -34,48 +45,166 @@ app = FastAPI(
 motion_controller_enabled = False
 motion_thread_started = False
 websocket_connections = set()
+# Held while the motion controller is started or stopped
+motion_lock = asyncio.Lock()
+# Reports event loop stalls in debug mode
+stall_monitor = None
+
+# Blocking calls never run on the event loop. 'control' opens and writes the motor
+# ports one call at a time, 'io' reads recordings and history.
+executors = {
+    'control': ThreadPoolExecutor(max_workers=1, thread_name_prefix='asc-control'),
+    'io': ThreadPoolExecutor(max_workers=2, thread_name_prefix='asc-io'),
+}
+
+async def run_blocking(kind, function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executors[kind], functools.partial(function, *args, **kwargs))
+
+# Joystick echo to the other browsers: frames waiting per client, and how long a client
+# may keep its queue full before it is disconnected
+CLIENT_QUEUE_SIZE = 8
+CLIENT_LAG_LIMIT = 5.0
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, rate=0.0, binary=False):
+        self.websocket = websocket
+        self.binary = binary
+        # A throttled client only ever gets the newest frame, so it keeps just that one
+        self.queue = asyncio.Queue(maxsize=1 if rate > 0 else CLIENT_QUEUE_SIZE)
+        self.rate = rate
+        # Waiting out its own throttle interval with a full queue is not lagging
+        self.lag_limit = CLIENT_LAG_LIMIT + (1.0 / rate if rate > 0 else 0.0)
+        self.sent = 0
+        self.dropped = 0
+        self.full_since = None
+        self.writer = None
+
+    def offer(self, message):
+        # Never waits: when the queue is full the oldest frame makes room
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            if self.full_since is None:
+                self.full_since = time.monotonic()
+        else:
+            self.full_since = None
+        self.queue.put_nowait(message)
+
+    def lagging(self):
+        return self.full_since is not None and time.monotonic() - self.full_since > self.lag_limit
+
+    async def run(self):
+        last_sent = 0.0
+        while True:
+            message = await self.queue.get()
+            if self.rate > 0:
+                delay = last_sent + 1.0 / self.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # Only the newest frame is worth sending
+            while not self.queue.empty():
+                message = self.queue.get_nowait()
+                self.dropped += 1
+            last_sent = time.monotonic()
+            if self.binary:
+                await self.websocket.send_bytes(message.binary())
+            else:
+                await self.websocket.send_text(message.text())
+            self.sent += 1
 
 # Connection Manager for WebSockets
 class ConnectionManager:
+    """Fans joystick frames out without waiting on any client.
+
+    Every client has a bounded queue and its own writer task, so a slow viewer
+    only loses stale frames and never delays the pilot's receive loop.
+    """
+
     def __init__(self):
         self.active_connections = []
+        self.clients = {}
+        self.disconnected_lagging = 0
+        # Frames that could not be decoded, skipped without closing the socket
+        self.malformed = 0
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
+        # Optional echo throttling per client: /ws/joystick?rate=10
+        try:
+            rate = max(0.0, float(websocket.query_params.get('rate', 0)))
+        except ValueError:
+            rate = 0.0
+        # Clients asking for ?format=binary get the echo as binary frames, others as JSON
+        binary = websocket.query_params.get('format') == 'binary'
+        client = ClientConnection(websocket, rate, binary)
+        client.writer = asyncio.create_task(self.write_(client))
+        self.clients[websocket] = client
         self.active_connections.append(websocket)
         websocket_connections.add(websocket)
 
+    async def write_(self, client):
+        try:
+            await client.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A failed send only ends that client's writer
+            logger.warning(f"Joystick WebSocket send failed: {e}")
+            self.disconnect(client.websocket)
+
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
         if websocket in websocket_connections:
             websocket_connections.remove(websocket)
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+    def broadcast(self, message):
+        for client in list(self.clients.values()):
+            client.offer(message)
+            if client.lagging():
+                logger.warning("Disconnecting a joystick WebSocket client that stopped keeping up")
+                self.disconnected_lagging += 1
+                self.disconnect(client.websocket)
+                asyncio.create_task(self.close_(client.websocket))
+
+    @staticmethod
+    async def close_(websocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            'clients': [{'format': 'binary' if client.binary else 'json', 'rate': client.rate, 'queued': client.queue.qsize(), 'sent': client.sent,
+                         'dropped': client.dropped} for client in self.clients.values()],
+            'disconnected_lagging': self.disconnected_lagging,
+            'malformed': self.malformed,
+        }
 
 manager = ConnectionManager()
 
 # Motion controller thread
 def run_motion_controller():
     import json
-    from motion import command_queue, send_command_to_motors, state_manager
+    from motion import command_slot, send_command_to_motors, state_manager, handoff_latency
     
     while True:
-        if not motion_controller_enabled:
-            time.sleep(0.1)
-            continue
-            
-        # Process any commands in the queue
+        # Wakes up as soon as a command is posted, only the newest one is sent
         try:
-            if not command_queue.empty():
-                command = command_queue.get(block=False)
-                if command is not None:
-                    send_command_to_motors(command["speed"], command["direction_one"], command["direction_two"])
+            command = command_slot.take(timeout=0.5)
+            # Commands posted while motion is disabled are dropped
+            if command is not None and motion_controller_enabled:
+                received = command.get("received")
+                if received is not None:
+                    handoff_latency.observe(time.monotonic() - received)
+                send_command_to_motors(command["speed"], command["direction_one"], command["direction_two"], received)
         except Exception as e:
             logger.error(f"Error in motion controller: {e}")
-        
-        time.sleep(0.01)
+            time.sleep(0.1)
 
 # Motion controller thread (will be started when needed)
 motion_thread = None
@@ -97,18 +226,48 @@ class CAMToggle(BaseModel):
     cam_num: int
     state: int
 
-# Sensor Thread
-def sensor_data():
-    global stack
-    while True:
-        retv = json.dumps({'current': stack.get_current_sensor_data()})
-        time.sleep(1)
-        # logger.info(f"Sensor data: {retv}")
+class SamplingConfig(BaseModel):
+    device: str
+    rate: float = None
+    adaptive: bool = None
+    min_rate: float = None
+    change: float = None
+    limit: float = None
+    mode: str = None
+    oversampling: int = None
+
+class BatchOperation(BaseModel):
+    # 'switch': board, channel, state; 'pwm': channel, percentage; 'led': led_num, state and/or val
+    op: str
+    board: int = None
+    channel: int = None
+    state: int = None
+    percentage: float = None
+    led_num: int = None
+    val: int = None
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+class PWMMove(BaseModel):
+    channel: int
+    percentage: float
+    ramp: float = None
+    velocity: float = None
+
+class PWMMoveRequest(BaseModel):
+    moves: List[PWMMove]
+
+class RecordingToggle(BaseModel):
+    enabled: bool
+
+class ReplayRequest(BaseModel):
+    session: str = None
+    speed: float = 1.0
+    start: float = None
+    end: float = None
 
 stack = Stack()
-sensor_thread = threading.Thread(target=sensor_data)
-sensor_thread.daemon = True
-sensor_thread.start()
 
 # API Endpoints
 @app.post("/start_joystick")
@@ -127,47 +286,60 @@ async def stop_joystick():
 @version(1, 0)
 async def start_motion():
     global motion_controller_enabled, motion_thread_started, motion_thread
-    if motion_controller_enabled:
-        return {"status": "error", "message": "Motion controller is already running."}
-    try:
-        # Initialize motion controller
-        from motion import initialize_motion_controller
-        if not initialize_motion_controller():
-            return {"status": "error", "message": "Failed to initialize motion controller"}
-        
-        # Start motion thread if not already started
-        if not motion_thread_started:
-            motion_thread = threading.Thread(target=run_motion_controller, daemon=True)
-            motion_thread.start()
-            motion_thread_started = True
-        
-        # Enable motion processing
-        motion_controller_enabled = True
-        return {"status": "success", "message": "Motion controller started."}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    async with motion_lock:
+        if motion_controller_enabled:
+            return {"status": "error", "message": "Motion controller is already running."}
+        try:
+            # Initialize motion controller, the Arduinos take seconds to boot
+            from motion import initialize_motion_controller
+            if not await run_blocking('control', initialize_motion_controller):
+                return {"status": "error", "message": "Failed to initialize motion controller"}
+            
+            # Start motion thread if not already started
+            if not motion_thread_started:
+                motion_thread = threading.Thread(target=run_motion_controller, daemon=True)
+                motion_thread.start()
+                motion_thread_started = True
+            
+            # Enable motion processing
+            motion_controller_enabled = True
+            return {"status": "success", "message": "Motion controller started."}
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
 
 @app.post("/stop_motion")
 @version(1, 0)
 async def stop_motion():
     global motion_controller_enabled
-    if not motion_controller_enabled:
-        return {"status": "error", "message": "Motion controller is not running."}
-    
-    # Disable motion processing
-    motion_controller_enabled = False
-    
-    # Stop motors
-    from motion import send_command_to_motors
-    send_command_to_motors(0, "STOP", "STOP")
-    
-    return {"status": "success", "message": "Motion controller stopped."}
+    async with motion_lock:
+        if not motion_controller_enabled:
+            return {"status": "error", "message": "Motion controller is not running."}
+        
+        # Disable motion processing
+        motion_controller_enabled = False
+        
+        # Stop motors, this reopens the ports if they were lost
+        from motion import send_command_to_motors
+        await run_blocking('control', send_command_to_motors, 0, "STOP", "STOP")
+        
+        return {"status": "success", "message": "Motion controller stopped."}
+
+@app.get("/motion_stats", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_motion_stats():
+    from motion import command_slot, motion_stats
+    # 'superseded' counts setpoints replaced by a newer one before they were sent
+    stats = command_slot.stats()
+    stats.update(motion_stats())
+    return {"success": True, 'stats': stats}
 
 @app.post("/led_toggle", status_code=status.HTTP_200_OK)
 @version(1, 0)
 async def handle_led_toggle(data: LEDToggle):
     led_num = data.led_num
     state = data.state
+    if not led_controller.valid_channel(led_num):
+        return {"success": False, "message": f"Unknown LED channel {led_num}"}
     
     # Store the switch state
     led_controller.set_switch_state(led_num, state)
@@ -191,6 +363,8 @@ async def handle_led_toggle(data: LEDToggle):
 async def handle_led_brightness(data: LEDVALToggle):
     led_num = data.led_num
     val = data.val
+    if not led_controller.valid_channel(led_num):
+        return {"success": False, "message": f"Unknown LED channel {led_num}"}
     
     # Store the brightness value regardless of switch state
     led_controller.brightness_values[led_num] = val
@@ -201,6 +375,17 @@ async def handle_led_brightness(data: LEDVALToggle):
     
     return {"success": True, "message": f"LED Channel {led_num} brightness set to {val}"}
 
+@app.get("/joystick_clients", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_joystick_clients():
+    return {"success": True, 'stats': manager.stats()}
+
+@app.get("/led_stats", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_led_stats():
+    # 'coalesced': replaced by a newer value before it was sent, 'dropped': already applied
+    return {"success": True, 'stats': led_controller.stats()}
+
 @app.post("/motor_toggle", status_code=status.HTTP_200_OK)
 @version(1, 0)
 async def handle_motor_toggle(data: MOTORToggle):
@@ -219,6 +404,60 @@ async def handle_cam_toggle(data: CAMToggle):
     stack.switch(CAM_BOARD, cam_num + 1, state)
     return {"success": True, "message": f"CAMERA Channel {cam_num} toggled to {state}"}
 
+@app.get("/switch_state", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_switch_state():
+    # Requested outputs per board, and the pins as last read back by the acquisition loop
+    return {"success": True, "boards": stack.get_switch_state()}
+
+@app.post("/batch", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def handle_batch(data: BatchRequest):
+    # Everything is checked before anything is applied
+    bus_operations = []
+    leds = {}
+    for index, operation in enumerate(data.operations):
+        if (operation.op == 'switch' and None not in (operation.board, operation.channel, operation.state)
+                and 0 <= operation.board < telemetry_block.BOARDS and 1 <= operation.channel <= telemetry_block.CHANNELS):
+            bus_operations.append(('switch', operation.board, operation.channel, operation.state))
+        elif (operation.op == 'pwm' and None not in (operation.channel, operation.percentage)
+                and 0 <= operation.channel < pca9685.CHANNELS and 0 <= operation.percentage <= 100):
+            bus_operations.append(('pwm', operation.channel, operation.percentage))
+        elif (operation.op == 'led' and led_controller.valid_channel(operation.led_num)
+                and (operation.state, operation.val) != (None, None)):
+            leds[operation.led_num] = operation
+        else:
+            return {"success": False, "message": f"Invalid operation {index}: {operation.dict(exclude_none=True)}"}
+    # Same rules as /led_toggle and /led_brightness, all channels go out in one serial write
+    brightness = {}
+    for led_num, operation in leds.items():
+        if operation.val is not None:
+            led_controller.brightness_values[led_num] = operation.val
+        if operation.state is not None:
+            led_controller.set_switch_state(led_num, operation.state)
+        if led_controller.get_switch_state(led_num):
+            value = led_controller.get_brightness(led_num)
+            brightness[led_num] = 100 if value == 0 and operation.state else value
+        elif operation.state is not None:
+            brightness[led_num] = 0
+    if bus_operations:
+        stack.batch(bus_operations)
+    if brightness:
+        led_controller.set_brightnesses(brightness)
+    return {"success": True, "message": f"Applied {len(data.operations)} operations"}
+
+@app.post("/pwm_move", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def handle_pwm_move(data: PWMMoveRequest):
+    # One command per move, the acquisition loop steps every channel at a fixed rate
+    for move in data.moves:
+        if not 0 <= move.channel < pca9685.CHANNELS or not 0 <= move.percentage <= 100:
+            return {"success": False, "message": f"Channel {move.channel} or percentage {move.percentage} out of range"}
+        if (move.ramp is not None and move.ramp < 0) or (move.velocity is not None and move.velocity <= 0):
+            return {"success": False, "message": f"Invalid ramp or velocity for channel {move.channel}"}
+    stack.move_pwm([(move.channel, move.percentage, move.ramp, move.velocity) for move in data.moves])
+    return {"success": True, "message": f"Moving {len(data.moves)} channels"}
+
 @app.get("/sensor_data", status_code=status.HTTP_200_OK)
 @version(1, 0)
 async def get_sensor_data():
@@ -233,6 +472,92 @@ async def get_bme_data():
     retv = json.dumps({'bme': stack.get_bme_data()})
     return {"success": True, 'bmedata': retv}
 
+@app.get("/sensor_history", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_sensor_history(channel: str = None, window: float = 600, resolution: str = 'auto'):
+    # Without a channel, list the channels that have history
+    if channel is None:
+        return {"success": True, 'channels': telemetry_history.list_channels()}
+    try:
+        retv = await run_blocking('io', telemetry_history.query, channel, window, resolution)
+    except KeyError:
+        return {"success": False, "message": f"No history for channel {channel}"}
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    return {"success": True, 'history': retv}
+
+@app.get("/sampling", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_sampling():
+    global stack
+    return {"success": True, 'sampling': stack.get_sampling()}
+
+@app.post("/sampling", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def handle_sampling(data: SamplingConfig, response: Response):
+    global stack
+    # Only the fields sent by the client are changed
+    changes = data.dict(exclude_unset=True)
+    changes.pop('device')
+    try:
+        config = stack.set_sampling(data.device, **changes)
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"success": False, "message": str(e)}
+    return {"success": True, "message": f"Sampling for {data.device} updated", 'sampling': config}
+
+@app.get("/readiness", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_readiness():
+    # Served from the topology cache until discovery has probed every mux position
+    topology = stack.get_topology()
+    return {"success": True, "ready": topology["state"] == "ready", **topology, "led_link": led_controller.ready}
+
+@app.get("/bus_stats", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_bus_stats():
+    global stack
+    return {"success": True, 'stats': stack.get_bus_stats()}
+
+@app.post("/recording", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def handle_recording(data: RecordingToggle):
+    global stack
+    session = stack.set_recording(data.enabled)
+    message = f"Recording to {session}" if session else "Recording stopped"
+    return {"success": True, "message": message, 'session': session}
+
+@app.get("/recordings", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def get_recordings():
+    global stack
+    return {"success": True, 'recording': stack.get_recording(), 'sessions': await run_blocking('io', list_sessions)}
+
+@app.get("/recordings/{session}", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def export_recording(session: str, start: float = None, end: float = None):
+    # Column arrays per channel between start and end (Unix time), plus the command log
+    try:
+        retv = await run_blocking('io', lambda: RecordingReader(session).export(start, end))
+    except (FileNotFoundError, ValueError) as e:
+        return {"success": False, "message": str(e)}
+    return {"success": True, 'recording': retv}
+
+@app.post("/replay", status_code=status.HTTP_200_OK)
+@version(1, 0)
+async def handle_replay(data: ReplayRequest):
+    # Without a session the live telemetry is restored
+    if data.session is None:
+        telemetry_hub.stop_replay()
+        return {"success": True, "message": "Replay stopped"}
+    try:
+        # Mapping the segments and finding the first record touch the SD card
+        source = await run_blocking('io', lambda: ReplaySource(RecordingReader(data.session), data.speed, data.start, data.end))
+    except (FileNotFoundError, ValueError) as e:
+        return {"success": False, "message": str(e)}
+    telemetry_hub.replay(source)
+    return {"success": True, "message": f"Replaying {data.session} at {data.speed}x"}
+
 # Versioning and Static Files
 app = VersionedFastAPI(app, version="1.0.0", prefix_format="/v{major}.{minor}", enable_latest=True)
 
@@ -241,23 +566,109 @@ app = VersionedFastAPI(app, version="1.0.0", prefix_format="/v{major}.{minor}",
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
+        from motion import JoystickFrame, process_joystick_data
         while True:
-            # Receive joystick data
-            data = await websocket.receive_json()
+            # Receive joystick data, binary frames or JSON from older clients
+            message = await websocket.receive()
+            received = time.monotonic()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                if message.get("bytes") is not None:
+                    frame = JoystickFrame.from_binary(message["bytes"])
+                else:
+                    frame = JoystickFrame.from_json(message["text"])
+            except ValueError:
+                manager.malformed += 1
+                continue
+            frame.received = received
             
             # Process joystick data if motion is enabled
-            if motion_controller_enabled and "axes" in data:
-                from motion import process_joystick_data
-                process_joystick_data(data)
+            if motion_controller_enabled and frame.axes is not None:
+                process_joystick_data(frame)
                 
-            # Broadcast to all clients
-            await manager.broadcast(data)
+            # Queued for every client, slow ones only drop stale frames
+            manager.broadcast(frame)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(websocket)
 
+# WebSocket endpoint for pushed sensor data: /ws/telemetry?rate=10&channels=current/2,bme
+@app.websocket("/ws/telemetry")
+async def telemetry_endpoint(websocket: WebSocket):
+    await telemetry_hub.serve(websocket)
+
+@app.on_event("startup")
+async def start_telemetry():
+    # Samples are pushed from the acquisition process once and fanned out to all subscribers
+    telemetry_hub.add_listener(telemetry_history.record)
+    telemetry_hub.start(stack, asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+async def stop_acquisition():
+    # The acquisition process is not a daemon, it would otherwise outlive uvicorn
+    stack.stop()
+
+@app.on_event("startup")
+async def start_stall_monitor():
+    global stall_monitor
+    if DEBUG:
+        stall_monitor = StallMonitor(report=logger.warning)
+        stall_monitor.start(asyncio.get_running_loop())
+
+def collect_metrics():
+    # Read at scrape time from the counters the modules already keep
+    from motion import command_slot, motors
+    latency = stack.get_latency()
+    for stage in ('queue', 'dispatch', 'apply'):
+        yield ('asc_command_latency_seconds', 'histogram', 'Time from an actuation API call to the end of each stage in the acquisition loop',
+               {'stage': stage}, (LATENCY_BUCKETS,) + latency[f'command_{stage}'])
+    yield 'asc_sweep_seconds', 'histogram', 'Duration of one acquisition cycle', {}, (LATENCY_BUCKETS,) + latency['sweep']
+    for name in latency:
+        if name.startswith('job_'):
+            yield 'asc_bus_job_seconds', 'histogram', 'Run time of one bus job', {'job': name[4:]}, (LATENCY_BUCKETS,) + latency[name]
+    stats = stack.get_bus_stats()
+    yield 'asc_i2c_transactions_total', 'counter', 'I2C transactions', {}, int(stats['i2c_transactions'])
+    yield 'asc_i2c_errors_total', 'counter', 'Failed I2C transactions', {}, int(stats['i2c_errors'])
+    yield 'asc_acquisition_cycles_total', 'counter', 'Acquisition cycles, one per batch of due devices', {}, int(stats['cycles'])
+    yield 'asc_acquisition_sweeps_total', 'counter', 'Full sweeps, every power monitor channel read once', {}, int(stats['sweeps'])
+    for device in ('current', 'bme'):
+        yield 'asc_sensor_reads_total', 'counter', 'Sensor reads', {'device': device}, int(stats[f'{device}_reads'])
+    for priority in ('actuation', 'telemetry'):
+        labels = {'priority': priority}
+        yield 'asc_bus_jobs_total', 'counter', 'Bus jobs run', labels, int(stats[f'{priority}_jobs'])
+        yield 'asc_bus_queue_depth', 'gauge', 'Bus jobs waiting', labels, int(stats[f'{priority}_queued'])
+        yield 'asc_bus_deadline_misses_total', 'counter', 'Bus jobs finished after their deadline', labels, int(stats[f'{priority}_deadline_misses'])
+    yield 'asc_command_backlog', 'gauge', 'Actuation commands not yet picked up by the acquisition loop', {}, stack.get_command_backlog()
+    slot = command_slot.stats()
+    for result in ('posted', 'sent', 'superseded'):
+        yield 'asc_motor_setpoints_total', 'counter', 'Motor setpoints from the joystick', {'result': result}, slot[result]
+    for name, motor in motors.items():
+        port = motor.stats()
+        labels = {'motor': name}
+        yield 'asc_motor_writes_total', 'counter', 'Motor command writes', labels, port['writes']
+        yield 'asc_motor_write_errors_total', 'counter', 'Failed motor command writes', labels, port['write_errors']
+        yield 'asc_motor_crc_errors_total', 'counter', 'Corrupt frames from the motor controller', labels, port['crc_errors']
+    led = led_controller.stats()
+    yield 'asc_led_queue_depth', 'gauge', 'LED channels waiting to be sent', {}, led['queued']
+    for result in ('posted', 'coalesced', 'dropped'):
+        yield 'asc_led_updates_total', 'counter', 'LED brightness updates', {'result': result}, led[result]
+    clients = manager.stats()['clients']
+    yield 'asc_joystick_clients', 'gauge', 'Connected joystick WebSocket clients', {}, len(clients)
+    yield 'asc_joystick_client_queue_depth', 'gauge', 'Joystick frames queued for all clients', {}, sum(client['queued'] for client in clients)
+    yield 'asc_telemetry_subscribers', 'gauge', 'Connected telemetry WebSocket clients', {}, len(telemetry_hub.subscribers)
+    if stall_monitor is not None:
+        yield 'asc_event_loop_stalls_total', 'counter', 'Event loop stalls over the debug threshold', {}, stall_monitor.stats()['stalls']
+
+metrics.add_collector(collect_metrics)
+
+# Prometheus scrape target, outside the versioned API like the WebSockets
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Mount static files AFTER adding the websocket route
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
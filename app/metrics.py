@@ -0,0 +1,99 @@
+import bisect
+import threading
+
+# Latency histogram bucket upper bounds in seconds, 0.1 ms to 5 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram, observe() is a bisect and three additions."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Process-wide metrics in the Prometheus text format.
+
+    Histograms are created once and observed on the hot path. Everything that is
+    already counted elsewhere (queue depths, bus and loop statistics) is read by
+    collectors only when /metrics is scraped. A collector returns
+    (name, kind, help, labels, value) tuples; a histogram value is
+    (buckets, counts, sum, count).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = []
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = (help, Histogram(buckets))
+        return self.histograms[key][1]
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect_(self):
+        for (name, labels), (help, histogram) in list(self.histograms.items()):
+            yield name, 'histogram', help, dict(labels), (histogram.buckets,) + histogram.snapshot()
+        for collector in self.collectors:
+            try:
+                yield from collector()
+            except Exception as e:
+                print(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+
+    def render(self):
+        families = {}
+        for name, kind, help, labels, value in self.collect_():
+            families.setdefault(name, (kind, help, []))[2].append((labels, value))
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                    continue
+                buckets, counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_labels(dict(labels, le=bound))} {int(cumulative)}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(float(total))}')
+                lines.append(f'{name}_count{_labels(labels)} {int(count)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
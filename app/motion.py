@@ -1,6 +1,11 @@
-import serial
 import threading
-import queue
+import time
+import json
+import struct
+from collections import deque
+import serial_link
+import hardware
+from metrics import metrics
 
 # Serial port configuration
 NANO2_SERIAL_PORT = '/dev/MOT2'  # Left motor
@@ -10,8 +15,51 @@ BAUD_RATE = 9600
 # Max speed
 MAX_SPEED = 20
 
-# Thread-safe command queue
-command_queue = queue.Queue()
+class CommandSlot:
+    """Single-slot mailbox for motor setpoints, the newest command always wins.
+
+    put() overwrites whatever the motor thread has not picked up yet, so a slow
+    serial write never leaves a backlog of stale joystick commands behind it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.command = None
+        self.posted = 0
+        self.taken = 0
+        self.superseded = 0
+
+    def put(self, command):
+        with self.condition:
+            if self.command is not None:
+                self.superseded += 1
+            self.command = command
+            self.posted += 1
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        # Blocks until a command is posted, None on timeout
+        with self.condition:
+            if self.command is None:
+                self.condition.wait(timeout)
+            command, self.command = self.command, None
+            if command is not None:
+                self.taken += 1
+            return command
+
+    def stats(self):
+        with self.condition:
+            return {'posted': self.posted, 'sent': self.taken, 'superseded': self.superseded,
+                    'pending': self.command is not None}
+
+# Latest motor setpoint, written by the joystick handler and sent by the motor thread
+command_slot = CommandSlot()
+
+# Joystick to motor latency, every stage is measured from the WebSocket receive
+JOYSTICK_LATENCY = 'asc_joystick_latency_seconds'
+JOYSTICK_LATENCY_HELP = 'Time from receiving a joystick frame to the end of each control stage'
+process_latency = metrics.histogram(JOYSTICK_LATENCY, JOYSTICK_LATENCY_HELP, stage='process')
+handoff_latency = metrics.histogram(JOYSTICK_LATENCY, JOYSTICK_LATENCY_HELP, stage='handoff')
 
 # Track joystick state
 class StateManager:
@@ -32,27 +80,192 @@ class StateManager:
 
 state_manager = StateManager()
 
-# Serial connections
-nano1_serial = None
-nano2_serial = None
+class MotorPort:
+    """One motor controller on its own serial port.
+
+    A writer thread sends the newest setpoint and a reader thread collects the
+    responses, so the two motors are driven independently and a slow or partial
+    reply never holds up a setpoint.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.serial = None
+        self.slot = CommandSlot()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = False
+        # Send times of the commands still waiting for a response
+        self.outstanding = deque(maxlen=16)
+        self.last_write = (None, 0.0)
+        self.writes = 0
+        self.write_errors = 0
+        self.acks = 0
+        self.rtt_last = self.rtt_max = self.rtt_total = 0.0
+        self.last_response = None
+        self.rtt = metrics.histogram('asc_motor_rtt_seconds', 'Time from a motor command write to its acknowledgement', motor=name)
+        self.write_latency = metrics.histogram(JOYSTICK_LATENCY, JOYSTICK_LATENCY_HELP, stage='serial_write', motor=name)
+        # 'binary' frames or 'ascii' lines, agreed on every time the port is opened
+        self.protocol = 'ascii'
+        self.parser = serial_link.FrameParser()
+
+    def open(self):
+        port = hardware.Serial(self.path, BAUD_RATE, timeout=0.1, write_timeout=0.5)
+        # Wait for the Arduino to be ready, it resets when the port is opened
+        time.sleep(hardware.SERIAL_RESET_TIME)
+        port.reset_input_buffer()
+        port.reset_output_buffer()
+        self.protocol = serial_link.handshake(port)
+        self.parser.buffer.clear()
+        print(f"{self.name.capitalize()} motor link: {self.protocol} at {port.baudrate} baud")
+        with self.lock:
+            self.outstanding.clear()
+            previous, self.serial = self.serial, port
+        if previous:
+            previous.close()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.threads = [threading.Thread(target=self.writer_, daemon=True),
+                        threading.Thread(target=self.reader_, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self, generation, speed, direction, received=None):
+        self.slot.put((generation, speed, direction, received))
+
+    def close(self):
+        self.running = False
+        port, self.serial = self.serial, None
+        if port:
+            port.close()
+
+    def writer_(self):
+        while self.running:
+            command = self.slot.take(timeout=0.5)
+            if command is None:
+                continue
+            generation, speed, direction, received = command
+            port = None
+            try:
+                if self.serial is None:
+                    self.open()
+                port = self.serial
+                if self.protocol == 'binary':
+                    data = serial_link.encode_motor(direction, speed)
+                else:
+                    data = f"DIR:{direction},SPEED:{speed}\n".encode()
+                sent = time.monotonic()
+                port.write(data)
+                # Wait until the bytes are on the wire, newer setpoints collect in the slot meanwhile
+                port.flush()
+                if received is not None:
+                    self.write_latency.observe(time.monotonic() - received)
+                with self.lock:
+                    self.outstanding.append(sent)
+                    self.last_write = (generation, sent)
+                    self.writes += 1
+            except Exception as e:
+                print(f"Serial communication error on {self.name} motor: {e}")
+                self.write_errors += 1
+                # Reopened on the next command, the other motor keeps going. Only the
+                # port that failed is dropped, not one that open() put in place since.
+                with self.lock:
+                    if self.serial is port:
+                        self.serial = None
+                    else:
+                        port = None
+                try:
+                    if port: port.close()
+                except Exception:
+                    pass
+
+    def reader_(self):
+        buffer = b''
+        while self.running:
+            port = self.serial
+            if port is None:
+                time.sleep(0.1)
+                buffer = b''
+                continue
+            try:
+                data = port.read(port.in_waiting or 1)
+            except Exception:
+                time.sleep(0.1)
+                continue
+            if self.protocol == 'binary':
+                crc_errors = self.parser.crc_errors
+                for opcode, payload in self.parser.feed(data):
+                    if opcode == serial_link.OP_ACK:
+                        self.response_(f"ACK {payload.hex()}", time.monotonic())
+                # A corrupt ack still answered the oldest write, keep the rest aligned
+                with self.lock:
+                    for _ in range(self.parser.crc_errors - crc_errors):
+                        if self.outstanding:
+                            self.outstanding.popleft()
+                continue
+            # Only complete lines are parsed, a partial one waits for the rest
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                self.response_(line.decode(errors='replace').strip(), time.monotonic())
+
+    def response_(self, line, received):
+        if not line:
+            return
+        with self.lock:
+            self.last_response = line
+            if self.outstanding:
+                rtt = received - self.outstanding.popleft()
+                self.rtt.observe(rtt)
+                self.acks += 1
+                self.rtt_last = rtt
+                self.rtt_max = max(self.rtt_max, rtt)
+                self.rtt_total += rtt
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connected': self.serial is not None,
+                'protocol': self.protocol,
+                'baud': self.serial.baudrate if self.serial else None,
+                'crc_errors': self.parser.crc_errors,
+                'writes': self.writes,
+                'write_errors': self.write_errors,
+                'acks': self.acks,
+                'outstanding': len(self.outstanding),
+                'rtt_last': self.rtt_last,
+                'rtt_mean': self.rtt_total / self.acks if self.acks else 0.0,
+                'rtt_max': self.rtt_max,
+                'last_response': self.last_response,
+                'superseded': self.slot.superseded,
+            }
+
+# Motor controllers: MOT1 drives the right track, MOT2 the left one
+motors = {'right': MotorPort('right', NANO1_SERIAL_PORT), 'left': MotorPort('left', NANO2_SERIAL_PORT)}
+generation = 0
 
 def initialize_motion_controller():
     """Initialize the serial connections for motors"""
-    global nano1_serial, nano2_serial
     try:
-        nano1_serial = serial.Serial(NANO1_SERIAL_PORT, BAUD_RATE, timeout=1)
-        nano2_serial = serial.Serial(NANO2_SERIAL_PORT, BAUD_RATE, timeout=1)
+        # Both Arduinos boot at the same time
+        errors = []
+        def open_port(motor):
+            try:
+                motor.open()
+            except Exception as e:
+                errors.append(e)
+        openers = [threading.Thread(target=open_port, args=(motor,)) for motor in motors.values()]
+        for opener in openers: opener.start()
+        for opener in openers: opener.join()
+        if errors:
+            raise errors[0]
         print("Serial ports initialized.")
-        
-        # Wait for Arduino to be ready before sending commands
-        import time
-        time.sleep(2)  # Give Arduino time to initialize
-        
-        # Clear any pending data in the buffers
-        nano1_serial.reset_input_buffer()
-        nano1_serial.reset_output_buffer()
-        nano2_serial.reset_input_buffer()
-        nano2_serial.reset_output_buffer()
+        for motor in motors.values():
+            motor.start()
         
         # Send stop command to ensure motors are stopped
         send_command_to_motors(0, "STOP", "STOP")
@@ -64,60 +277,123 @@ def initialize_motion_controller():
 
 def cleanup_motion_controller():
     """Close serial connections"""
-    global nano1_serial, nano2_serial
     try:
-        if nano1_serial:
-            nano1_serial.close()
-        if nano2_serial:
-            nano2_serial.close()
+        for motor in motors.values():
+            motor.close()
     except Exception as e:
         print(f"Error closing serial ports: {e}")
 
-def send_command_to_motors(speed, direction_one, direction_two):
-    """Send command directly to motors via serial"""
-    global nano1_serial, nano2_serial
+def send_command_to_motors(speed, direction_one, direction_two, received=None):
+    """Hand the setpoint to both motor writers, they send it at the same time"""
+    global generation
     
-    if not nano1_serial or not nano2_serial:
+    if not all(motor.running for motor in motors.values()):
         # Try to initialize if not already done
         if not initialize_motion_controller():
             return
     
-    try:
-        # Map directions: motor1 = right motor, motor2 = left motor
-        motor1_command = f"DIR:{direction_two},SPEED:{speed}\n"  # Right motor
-        motor2_command = f"DIR:{direction_one},SPEED:{speed}\n"  # Left motor
-        
-        # Write commands to the correct motors
-        nano1_serial.write(motor1_command.encode())  # Right motor
-        nano2_serial.write(motor2_command.encode())  # Left motor
-
-        if nano1_serial.in_waiting:
-            response1 = nano1_serial.readline().decode().strip()
-            print(f"Right motor response: {response1}")
-        if nano2_serial.in_waiting:
-            response2 = nano2_serial.readline().decode().strip()
-            print(f"Left motor response: {response2}")
-            
-    except Exception as e:
-        print(f"Serial communication error: {e}")
-        # Try to reinitialize on error
-        initialize_motion_controller()
-
-# Safe axis parser
-def parse_axis(data, target_index):
-    for axis in data.get('axes', []):
-        if axis.get('index') == target_index:
+    # Map directions: right motor gets direction_two, left motor direction_one
+    generation += 1
+    motors['right'].send(generation, speed, direction_two, received)
+    motors['left'].send(generation, speed, direction_one, received)
+
+def motion_stats():
+    retv = {name: motor.stats() for name, motor in motors.items()}
+    # Time between the two writes of the last setpoint both motors got
+    right, left = motors['right'].last_write, motors['left'].last_write
+    retv['skew'] = abs(right[1] - left[1]) if right[0] is not None and right[0] == left[0] else None
+    return retv
+
+# Binary joystick frame: magic, 8 axes as float32, buttons bitmask (little endian).
+# 37 bytes instead of a few hundred for the JSON form.
+JOYSTICK_FRAME = struct.Struct('<B8fI')
+JOYSTICK_MAGIC = 0x4A
+JOYSTICK_AXES = 8
+
+class JoystickFrame:
+    """One joystick sample decoded into fixed axes and a buttons bitmask.
+
+    The wire forms are cached, so an echo to many clients is encoded at most once
+    per format, and never when it is forwarded in the format it arrived in.
+    """
+
+    __slots__ = ('axes', 'buttons', 'received', 'text_', 'binary_')
+
+    def __init__(self, axes=None, buttons=0):
+        self.axes = axes
+        self.buttons = buttons
+        # time.monotonic() when the frame came off the WebSocket
+        self.received = None
+        self.text_ = None
+        self.binary_ = None
+
+    @classmethod
+    def from_binary(cls, data):
+        if len(data) != JOYSTICK_FRAME.size or data[0] != JOYSTICK_MAGIC:
+            raise ValueError("Not a joystick frame")
+        values = JOYSTICK_FRAME.unpack(data)
+        # float32 to 4 decimals, so 0.9 stays 0.9 and not 0.8999999761
+        frame = cls(tuple(round(value, 4) for value in values[1:1 + JOYSTICK_AXES]), values[-1])
+        frame.binary_ = bytes(data)
+        return frame
+
+    @staticmethod
+    def entries_(data, key):
+        # Entries that are not objects are skipped, like out of range indices
+        entries = data.get(key)
+        if not isinstance(entries, list):
+            return []
+        return [entry for entry in entries if isinstance(entry, dict)]
+
+    @classmethod
+    def from_json(cls, text):
+        # Old clients: {"axes": [{"index": i, "value": v}, ...], "buttons": [...]}, decoded in one pass
+        data = json.loads(text)
+        frame = cls()
+        frame.text_ = text
+        if not isinstance(data, dict) or 'axes' not in data:
+            return frame
+        axes = [0.0] * JOYSTICK_AXES
+        for axis in cls.entries_(data, 'axes'):
+            index = axis.get('index')
+            if isinstance(index, int) and 0 <= index < JOYSTICK_AXES:
+                try:
+                    axes[index] = float(axis.get('value', 0.0))
+                except (ValueError, TypeError):
+                    pass
+        frame.axes = tuple(axes)
+        for button in cls.entries_(data, 'buttons'):
+            index = button.get('index')
             try:
-                return float(axis.get('value', 0.0))
+                pressed = float(button.get('value', 0)) > 0.5
             except (ValueError, TypeError):
-                return 0.0
-    return 0.0
+                pressed = False
+            if pressed and isinstance(index, int) and 0 <= index < 32:
+                frame.buttons |= 1 << index
+        return frame
+
+    def text(self):
+        if self.text_ is None:
+            self.text_ = json.dumps({
+                'axes': [{'index': i, 'value': value} for i, value in enumerate(self.axes or ())],
+                'buttons': [{'index': i, 'value': bool(self.buttons >> i & 1)} for i in range(32) if self.buttons >> i & 1],
+            })
+        return self.text_
+
+    def binary(self):
+        if self.binary_ is None:
+            self.binary_ = JOYSTICK_FRAME.pack(JOYSTICK_MAGIC, *(self.axes or (0.0,) * JOYSTICK_AXES), self.buttons)
+        return self.binary_
+
+def post_command_(frame, command):
+    command['received'] = frame.received
+    command_slot.put(command)
 
 # Process joystick data from WebSocket
-def process_joystick_data(data):
+def process_joystick_data(frame):
     try:
-        y_axis = parse_axis(data, 1)
-        x_axis = parse_axis(data, 2)
+        y_axis = frame.axes[1]
+        x_axis = frame.axes[2]
 
         speed = int(abs(y_axis) * MAX_SPEED) if abs(y_axis) > 0.1 else 0
 
@@ -125,39 +401,41 @@ def process_joystick_data(data):
             if x_axis < -0.5:
                 # Turn left while moving forward (left track slows/reverses)
                 if state_manager.update(speed // 2, "FORWARD", "BACKWARD"):
-                    command_queue.put({"speed": speed // 2, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
+                    post_command_(frame, {"speed": speed // 2, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
             elif x_axis > 0.5:
                 # Turn right while moving forward (right track slows/reverses)
                 if state_manager.update(speed // 2, "BACKWARD", "FORWARD"):
-                    command_queue.put({"speed": speed // 2, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
+                    post_command_(frame, {"speed": speed // 2, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
             else:
                 # Move straight forward
                 if state_manager.update(speed, "FORWARD", "FORWARD"):
-                    command_queue.put({"speed": speed, "direction_one": "FORWARD", "direction_two": "FORWARD"})
+                    post_command_(frame, {"speed": speed, "direction_one": "FORWARD", "direction_two": "FORWARD"})
         elif y_axis > 0.5:  # Backward
             if x_axis < -0.5:
                 # Turn left while moving backward
                 if state_manager.update(speed // 2, "FORWARD", "BACKWARD"):
-                    command_queue.put({"speed": speed // 2, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
+                    post_command_(frame, {"speed": speed // 2, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
             elif x_axis > 0.5:
                 # Turn right while moving backward
                 if state_manager.update(speed // 2, "BACKWARD", "FORWARD"):
-                    command_queue.put({"speed": speed // 2, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
+                    post_command_(frame, {"speed": speed // 2, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
             else:
                 # Move straight backward
                 if state_manager.update(speed, "BACKWARD", "BACKWARD"):
-                    command_queue.put({"speed": speed, "direction_one": "BACKWARD", "direction_two": "BACKWARD"})
+                    post_command_(frame, {"speed": speed, "direction_one": "BACKWARD", "direction_two": "BACKWARD"})
         elif x_axis < -0.5:
             # Turn left in place
             if state_manager.update(MAX_SPEED, "FORWARD", "BACKWARD"):
-                command_queue.put({"speed": MAX_SPEED, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
+                post_command_(frame, {"speed": MAX_SPEED, "direction_one": "FORWARD", "direction_two": "BACKWARD"})
         elif x_axis > 0.5:
             # Turn right in place
             if state_manager.update(MAX_SPEED, "BACKWARD", "FORWARD"):
-                command_queue.put({"speed": MAX_SPEED, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
+                post_command_(frame, {"speed": MAX_SPEED, "direction_one": "BACKWARD", "direction_two": "FORWARD"})
         else:
             # Stop
             if state_manager.update(0, "STOP", "STOP"):
-                command_queue.put({"speed": 0, "direction_one": "STOP", "direction_two": "STOP"})
+                post_command_(frame, {"speed": 0, "direction_one": "STOP", "direction_two": "STOP"})
+        if frame.received is not None:
+            process_latency.observe(time.monotonic() - frame.received)
     except Exception as e:
         print(f"Error processing joystick data: {e}")
@@ -0,0 +1,61 @@
+import time
+
+# PCA9685 16 channel PWM driver on the MuxBus. Register auto-increment is on, so
+# consecutive channels are written in one block write.
+ADDRESS = 0x40
+CHANNELS = 16
+RESOLUTION = 4096
+
+_MODE1 = 0x00
+_MODE2 = 0x01
+_LED0_ON_L = 0x06
+_ALL_LED_ON_L = 0xFA
+_PRESCALE = 0xFE
+
+_RESTART = 0x80
+_AUTO_INCREMENT = 0x20
+_SLEEP = 0x10
+_ALLCALL = 0x01
+_OUTDRV = 0x04
+
+_OSCILLATOR = 25000000.0
+# An SMBus block write carries at most 32 bytes, 4 per channel
+BURST_CHANNELS = 8
+
+
+def setup(bus, address=ADDRESS):
+    # All outputs off, totem pole outputs, auto-increment on, oscillator running
+    bus.write_i2c_block_data(address, _ALL_LED_ON_L, [0, 0, 0, 0])
+    bus.write_byte_data(address, _MODE2, _OUTDRV)
+    bus.write_byte_data(address, _MODE1, _ALLCALL | _AUTO_INCREMENT)
+    time.sleep(0.005)
+
+
+def set_frequency(bus, freq, address=ADDRESS):
+    # The prescaler can only be written while the oscillator is asleep
+    prescale = int(round(_OSCILLATOR / (RESOLUTION * freq) - 1.0))
+    mode = bus.read_byte_data(address, _MODE1) & ~_RESTART & 0xFF
+    bus.write_byte_data(address, _MODE1, mode | _SLEEP)
+    bus.write_byte_data(address, _PRESCALE, prescale)
+    bus.write_byte_data(address, _MODE1, mode & ~_SLEEP)
+    time.sleep(0.005)
+    bus.write_byte_data(address, _MODE1, (mode & ~_SLEEP) | _RESTART)
+
+
+def write_channels(bus, first, counts, address=ADDRESS):
+    # Off counts (on at 0) for channels first, first + 1, ..., in as few block writes
+    # as fit. Returns the number of writes.
+    writes = 0
+    for start in range(0, len(counts), BURST_CHANNELS):
+        data = []
+        for count in counts[start:start + BURST_CHANNELS]:
+            count = max(0, min(RESOLUTION - 1, int(count)))
+            data += [0, 0, count & 0xFF, count >> 8]
+        bus.write_i2c_block_data(address, _LED0_ON_L + 4 * (first + start), data)
+        writes += 1
+    return writes
+
+
+def write_all(bus, count, address=ADDRESS):
+    count = max(0, min(RESOLUTION - 1, int(count)))
+    bus.write_i2c_block_data(address, _ALL_LED_ON_L, [0, 0, count & 0xFF, count >> 8])
@@ -0,0 +1,303 @@
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+# Where sessions are written, /root/.config is bind-mounted from the vehicle
+RECORD_DIR = os.environ.get('ASC_RECORD_DIR', '/root/.config/asc/recordings')
+
+# Every record has the same size: time, kind, two address bytes and three values.
+#   current: a=board, b=channel, values=(current, volt, watt)
+#   bme:     a=slot,             values=(temperature, pressure, humidity)
+#   command: a=command code,     values=command arguments
+RECORD = struct.Struct('<dBBH3d')
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('kind', 'u1'), ('a', 'u1'), ('b', '<u2'), ('values', '<f8', (3,))])
+KIND_CURRENT = 1
+KIND_BME = 2
+KIND_COMMAND = 3
+COMMAND_CODES = {'switch': 1, 'pwm': 2, 'pwm_freq': 3, 'rpi_pwm': 4, 'pwm_move': 5}
+COMMAND_NAMES = {code: name for name, code in COMMAND_CODES.items()}
+
+# Segment header: magic, record size, reserved
+MAGIC = b'ASCREC01'
+HEADER = struct.Struct('<8sII')
+SEGMENT_RECORDS = 1 << 19
+
+
+def segment_path(directory, session, index):
+    return os.path.join(directory, f"{session}-{index:05d}.rec")
+
+
+def new_session(directory=RECORD_DIR):
+    # Millisecond timestamp, with a counter if a session by that name already exists
+    now = time.time()
+    name = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f".{int(now * 1000) % 1000:03d}"
+    session, count = name, 1
+    while os.path.exists(segment_path(directory, session, 0)):
+        session = f"{name}_{count}"
+        count += 1
+    return session
+
+
+class Recorder:
+    """Append-only recorder of telemetry and actuation commands into rotating segment files.
+
+    record_*() only packs into a memory buffer. A writer thread appends the buffer every
+    flush_interval and fsyncs every sync_interval, so the acquisition loop never waits
+    on the SD card.
+    """
+
+    def __init__(self, directory=RECORD_DIR, flush_interval=0.5, sync_interval=5.0, segment_records=SEGMENT_RECORDS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.segment_records = segment_records
+        self.session = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.file = None
+        self.segment = 0
+        self.segment_count = 0
+        self.records = 0
+
+    def start(self, session):
+        if self.session is not None:
+            self.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        self.session = session
+        self.segment = 0
+        self.records = 0
+        try:
+            self.open_segment_()
+        except Exception:
+            self.session = None
+            raise
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.writer_, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.session is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.session = None
+
+    def record_current(self, stamp, board, channel, reading):
+        if self.session is not None:
+            self.append_(RECORD.pack(stamp, KIND_CURRENT, board, channel, reading['current'], reading['volt'], reading['watt']))
+
+    def record_bme(self, stamp, slot, reading):
+        if self.session is not None:
+            self.append_(RECORD.pack(stamp, KIND_BME, slot, 0, reading['temperature'], reading['pressure'], reading['humidity']))
+
+    def record_command(self, stamp, command):
+        code = COMMAND_CODES.get(command[0])
+        if self.session is not None and code is not None:
+            args = [float(arg) for arg in command[1:4]]
+            args += [0.0] * (3 - len(args))
+            self.append_(RECORD.pack(stamp, KIND_COMMAND, code, 0, *args))
+
+    def append_(self, record):
+        with self.lock:
+            self.buffer.append(record)
+
+    def open_segment_(self):
+        # Never appends to an existing segment, a second header would misalign every record after it
+        self.file = open(segment_path(self.directory, self.session, self.segment), 'xb')
+        self.file.write(HEADER.pack(MAGIC, RECORD.size, 0))
+        self.segment_count = 0
+
+    def writer_(self):
+        last_sync = time.monotonic()
+        while True:
+            # Wakes up early when stop() is called, for a last flush
+            stopping = self.stopping.wait(self.flush_interval)
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            try:
+                self.write_(batch)
+                if stopping or time.monotonic() - last_sync >= self.sync_interval:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    last_sync = time.monotonic()
+            except Exception as e:
+                print(f"Recorder write error: {e}")
+            if stopping:
+                self.file.close()
+                self.file = None
+                return
+
+    def write_(self, batch):
+        while batch:
+            room = self.segment_records - self.segment_count
+            if room <= 0:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.segment += 1
+                self.open_segment_()
+                continue
+            chunk, batch = batch[:room], batch[room:]
+            self.file.write(b''.join(chunk))
+            self.segment_count += len(chunk)
+            self.records += len(chunk)
+
+
+def list_sessions(directory=RECORD_DIR):
+    sessions = {}
+    if not os.path.isdir(directory):
+        return []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.rec') and '-' in name:
+            session = name.rsplit('-', 1)[0]
+            sessions.setdefault(session, []).append(os.path.join(directory, name))
+    retv = []
+    for session in sorted(sessions):
+        reader = RecordingReader(session, directory)
+        times = [segment['time'] for segment in reader.segments if len(segment)]
+        retv.append({
+            'session': session,
+            'segments': len(sessions[session]),
+            'records': sum(len(segment) for segment in reader.segments),
+            'bytes': sum(os.path.getsize(path) for path in sessions[session]),
+            'start': float(times[0][0]) if times else None,
+            'end': float(times[-1][-1]) if times else None,
+        })
+    return retv
+
+
+class RecordingReader:
+    """Memory-mapped view of a recorded session, records are in time order."""
+
+    def __init__(self, session, directory=RECORD_DIR):
+        if not session or os.path.basename(session) != session:
+            raise ValueError(f"Invalid recording name {session}")
+        self.session = session
+        self.segments = []
+        index = 0
+        while os.path.exists(segment_path(directory, session, index)):
+            self.segments.append(self.map_(segment_path(directory, session, index)))
+            index += 1
+        if not self.segments:
+            raise FileNotFoundError(f"No recording named {session}")
+
+    @staticmethod
+    def map_(path):
+        count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+        if count <= 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        with open(path, 'rb') as f:
+            magic, size, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.size:
+            raise ValueError(f"{path} is not a recording segment")
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+    def slices(self, start=None, end=None):
+        # Views of the records in [start, end], one per segment, found by binary search.
+        # Nothing is copied, only the pages that are read are loaded.
+        for segment in self.segments:
+            if not len(segment):
+                continue
+            times = segment['time']
+            lo = 0 if start is None else np.searchsorted(times, start, 'left')
+            hi = len(segment) if end is None else np.searchsorted(times, end, 'right')
+            if hi > lo:
+                yield segment[lo:hi]
+
+    def export(self, start=None, end=None):
+        """Records in [start, end] as column arrays per channel, plus the command log."""
+        channels = {}
+        commands = []
+        for part in self.slices(start, end):
+            kinds = part['kind']
+            for kind, fields in ((KIND_CURRENT, ('current', 'volt', 'watt')),
+                                 (KIND_BME, ('temperature', 'pressure', 'humidity'))):
+                rows = np.flatnonzero(kinds == kind)
+                if not len(rows):
+                    continue
+                keys = part['a'][rows].astype(np.uint32) << 16 | part['b'][rows]
+                for key in np.unique(keys).tolist():
+                    selected = rows[keys == key]
+                    channel = channels.setdefault((kind, key >> 16, key & 0xFFFF), {'time': [], **{field: [] for field in fields}})
+                    channel['time'] += part['time'][selected].tolist()
+                    values = part['values'][selected]
+                    for index, field in enumerate(fields):
+                        channel[field] += values[:, index].tolist()
+            for row in np.flatnonzero(kinds == KIND_COMMAND).tolist():
+                commands.append({
+                    'time': float(part['time'][row]),
+                    'command': COMMAND_NAMES.get(int(part['a'][row]), str(part['a'][row])),
+                    'args': part['values'][row].tolist(),
+                })
+        retv = {'session': self.session, 'channels': {}, 'commands': commands}
+        for kind, a, b in sorted(channels):
+            name = f"current/{a}/{b}" if kind == KIND_CURRENT else f"bme/{a}"
+            retv['channels'][name] = channels[(kind, a, b)]
+        return retv
+
+
+class ReplaySource:
+    """Plays a recording back as telemetry samples, paced like the original session.
+
+    Has the same wait_for_sample() as Stack, so the telemetry hub can use it in place
+    of the live acquisition. Readings sharing a timestamp form one sample.
+    """
+
+    def __init__(self, reader, speed=1.0, start=None, end=None):
+        self.session = reader.session
+        # Walks the memory-mapped segments, the session is never loaded as a whole
+        self.parts = reader.slices(start, end)
+        self.part = np.zeros(0, dtype=RECORD_DTYPE)
+        self.speed = max(speed, 0.01)
+        self.index = 0
+        self.seq = 0
+        self.current = {}
+        self.bme = {}
+        self.started = None
+        self.finished = self.peek_() is None
+
+    def peek_(self):
+        # The next telemetry record, commands are skipped. None at the end.
+        while True:
+            while self.index < len(self.part):
+                row = self.part[self.index]
+                if row['kind'] != KIND_COMMAND:
+                    return row
+                self.index += 1
+            part = next(self.parts, None)
+            if part is None:
+                return None
+            self.part, self.index = part, 0
+
+    def wait_for_sample(self, timeout=None):
+        if self.finished:
+            return None
+        row = self.peek_()
+        stamp = float(row['time'])
+        if self.started is None:
+            self.started = (time.monotonic(), stamp)
+        due = self.started[0] + (stamp - self.started[1]) / self.speed
+        delay = due - time.monotonic()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return None
+        if delay > 0:
+            time.sleep(delay)
+        while row is not None and row['time'] == stamp:
+            values = row['values'].tolist()
+            if row['kind'] == KIND_CURRENT:
+                reading = dict(zip(('current', 'volt', 'watt'), values), time=stamp)
+                self.current.setdefault(int(row['a']), {})[int(row['b'])] = reading
+            else:
+                self.bme[int(row['a'])] = dict(zip(('temperature', 'pressure', 'humidity'), values), time=stamp)
+            self.index += 1
+            row = self.peek_()
+        self.finished = row is None
+        self.seq += 1
+        current = {board: dict(channels) for board, channels in self.current.items()}
+        return {'seq': self.seq, 'time': stamp, 'current': current, 'bme': dict(self.bme), 'replay': self.session}
@@ -0,0 +1,73 @@
+import time
+from collections import deque
+
+# Priority classes, a lower number always runs first
+ACTUATION = 0
+TELEMETRY = 1
+PRIORITY_NAMES = ('actuation', 'telemetry')
+
+# Default completion deadline of a job in each class, seconds after submission
+DEADLINES = (0.01, 1.0)
+
+
+class BusScheduler:
+    """Runs bus jobs one at a time, always the oldest job of the most urgent class.
+
+    Jobs are kept small (about one device transaction), so a newly submitted
+    actuation waits for at most the job that is already running.
+    """
+
+    def __init__(self, job_times=None):
+        # Optional job name -> metrics.Histogram of run times
+        self.job_times = job_times or {}
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.jobs = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+        self.deadline_misses = [0] * len(PRIORITY_NAMES)
+
+    def submit(self, priority, job, *args, deadline=None):
+        now = time.monotonic()
+        if deadline is None:
+            deadline = DEADLINES[priority]
+        self.queues[priority].append((now, now + deadline, job, args))
+
+    def pending(self, priority=None):
+        if priority is None:
+            return sum(len(jobs) for jobs in self.queues)
+        return len(self.queues[priority])
+
+    def run_next(self):
+        for priority, jobs in enumerate(self.queues):
+            if jobs:
+                break
+        else:
+            return False
+        submitted, deadline, job, args = jobs.popleft()
+        started = time.monotonic()
+        wait = started - submitted
+        self.jobs[priority] += 1
+        self.wait_total[priority] += wait
+        self.wait_max[priority] = max(self.wait_max[priority], wait)
+        try:
+            job(*args)
+        except Exception as e:
+            print(f"Error in {PRIORITY_NAMES[priority]} job {getattr(job, '__name__', job)}: {e}")
+        finished = time.monotonic()
+        histogram = self.job_times.get(getattr(job, '__name__', None))
+        if histogram is not None:
+            histogram.observe(finished - started)
+        if finished > deadline:
+            self.deadline_misses[priority] += 1
+        return True
+
+    def stats(self):
+        retv = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            jobs = self.jobs[priority]
+            retv[f'{name}_jobs'] = jobs
+            retv[f'{name}_queued'] = len(self.queues[priority])
+            retv[f'{name}_wait_mean'] = self.wait_total[priority] / jobs if jobs else 0.0
+            retv[f'{name}_wait_max'] = self.wait_max[priority]
+            retv[f'{name}_deadline_misses'] = self.deadline_misses[priority]
+        return retv
@@ -0,0 +1,119 @@
+import os
+import struct
+import time
+
+# Binary framing for the motor and LED Arduinos, negotiated at startup.
+#   SYNC | opcode | payload length | payload | CRC-8 of opcode, length and payload
+# A motor setpoint is 6 bytes instead of about 22 for "DIR:FORWARD,SPEED:20\n".
+SYNC = 0xA5
+PROTOCOL_VERSION = 1
+
+OP_MOTOR = 0x01       # direction, speed
+OP_BRIGHTNESS = 0x02  # led index, brightness
+OP_HELLO = 0x7E       # version, requested baud rate (uint32)
+OP_ACK = 0x80         # acknowledged opcode, status
+OP_HELLO_ACK = 0xFE   # version
+
+DIRECTIONS = {'STOP': 0, 'FORWARD': 1, 'BACKWARD': 2}
+MAX_PAYLOAD = 32
+
+# 'auto' tries the binary protocol and falls back to ASCII, 'ascii' never tries
+PROTOCOL = os.environ.get('ASC_SERIAL_PROTOCOL', 'auto')
+# Baud rate both ends switch to once the binary protocol is agreed on
+FAST_BAUD_RATE = int(os.environ.get('ASC_SERIAL_BAUD', 115200))
+HANDSHAKE_TIMEOUT = 0.3
+
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+_CRC8 = _crc8_table()
+
+
+def crc8(data):
+    # CRC-8/SMBUS (polynomial 0x07), cheap to compute on the Arduino as well
+    crc = 0
+    for byte in data:
+        crc = _CRC8[crc ^ byte]
+    return crc
+
+
+def encode(opcode, payload=b''):
+    body = bytes((opcode, len(payload))) + payload
+    return bytes((SYNC,)) + body + bytes((crc8(body),))
+
+
+def encode_motor(direction, speed):
+    return encode(OP_MOTOR, bytes((DIRECTIONS[direction], max(0, min(255, int(speed))))))
+
+
+def encode_brightness(index, brightness):
+    return encode(OP_BRIGHTNESS, bytes((index, max(0, min(100, int(brightness))))))
+
+
+class FrameParser:
+    """Incremental frame decoder, resynchronises on the next SYNC byte after any error."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, data):
+        # Returns the complete frames in data as (opcode, payload)
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < 3:
+                return frames
+            if self.buffer[2] > MAX_PAYLOAD:
+                # Not a real frame start
+                del self.buffer[:1]
+                continue
+            if len(self.buffer) < 4 + self.buffer[2]:
+                return frames
+            end = 3 + self.buffer[2]
+            body = bytes(self.buffer[1:end])
+            if crc8(body) == self.buffer[end]:
+                frames.append((body[0], body[2:]))
+                del self.buffer[:end + 1]
+            else:
+                self.crc_errors += 1
+                del self.buffer[:1]
+
+
+def handshake(port, baud=FAST_BAUD_RATE, protocol=PROTOCOL, timeout=HANDSHAKE_TIMEOUT):
+    """Agrees on the protocol with a freshly opened controller, returns 'binary' or 'ascii'.
+
+    Firmware without binary support never answers the hello frame, and the link
+    stays on ASCII at the current baud rate.
+    """
+    if protocol == 'ascii':
+        return 'ascii'
+    port.reset_input_buffer()
+    # The trailing newline ends the line an ASCII-only firmware sees, so it drops it
+    port.write(encode(OP_HELLO, struct.pack('<BI', PROTOCOL_VERSION, baud)) + b'\n')
+    parser = FrameParser()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for opcode, payload in parser.feed(port.read(port.in_waiting or 1)):
+            if opcode == OP_HELLO_ACK and payload and payload[0] == PROTOCOL_VERSION:
+                port.flush()
+                if baud != port.baudrate:
+                    port.baudrate = baud
+                    time.sleep(0.01)
+                port.reset_input_buffer()
+                return 'binary'
+    # Whatever an ASCII firmware answered to the hello line
+    port.reset_input_buffer()
+    return 'ascii'
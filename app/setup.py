@@ -22,13 +22,12 @@ setup(
         "uvicorn == 0.13.4",
         "starlette==0.13.6",
         "aiofiles==0.8.0",
-        "Adafruit-PCA9685==1.0.1",
-        "bme280==0.6",
         "RPi.GPIO==0.7.0",
         "smbus==1.1.post2",
         "flask==3.0.3",
         "Flask-SocketIO==5.4.1",
         "python-socketio==5.11.4",
         "pyserial==3.5",
+        "numpy==1.26.4",
     ],
 )
\ No newline at end of file
@@ -0,0 +1,400 @@
+import os
+import random
+import struct
+import threading
+import time
+import serial_link
+
+# Simulated vehicle hardware, selected with ASC_HARDWARE=sim (see hardware.py).
+# Every I2C transaction and serial write costs `latency` seconds, sensor readings get
+# relative gaussian `noise`, and a transaction fails with probability `fault_rate`.
+SIM_LATENCY = float(os.environ.get('ASC_SIM_LATENCY', 0.0002))
+SIM_NOISE = float(os.environ.get('ASC_SIM_NOISE', 0.01))
+SIM_FAULT_RATE = float(os.environ.get('ASC_SIM_FAULT_RATE', 0.0))
+# Sensor boards present, by primary mux channel minus 2, and BMEs as "primary/secondary" channels
+SIM_BOARDS = os.environ.get('ASC_SIM_BOARDS', '0,1,2,3')
+SIM_BMES = os.environ.get('ASC_SIM_BMES', ','.join(f'{a}/{b}' for a in range(2) for b in range(8)))
+# 'binary' Arduinos answer the serial_link handshake, 'ascii' ones behave like the current sketches
+SIM_SERIAL_PROTOCOL = os.environ.get('ASC_SIM_SERIAL_PROTOCOL', 'binary')
+
+PRIMARY_MUX = 0x77
+SECONDARY_MUX = 0x71
+EXPANDER = 0x41
+POWER_MONITORS = (0b1110000, 0b1110011, 0b1111100, 0b1111111)
+BME = 0x76
+PWM_DRIVER = 0x40
+
+
+def _remote_io_error():
+    # What smbus raises for a device that does not acknowledge
+    return OSError(121, 'Remote I/O error')
+
+
+class SimDevice:
+    """Register file of one I2C device, subclasses compute the readable registers."""
+
+    def __init__(self, world):
+        self.world = world
+        self.registers = {}
+
+    def write(self, register, data):
+        for offset, value in enumerate(data):
+            self.registers[register + offset] = value & 0xFF
+
+    def read(self, register, length):
+        return [self.registers.get(register + offset, 0) for offset in range(length)]
+
+
+class SimExpander(SimDevice):
+    """Output expander of a sensor board, register 0x01 switches the four channels.
+
+    0x00 reads the pin levels, 0x03 sets the direction (1 = input, pulled high).
+    Both 0x01 and 0x03 come up as 0xFF, after power-up or a brown_out().
+    """
+
+    def __init__(self, world):
+        super().__init__(world)
+        self.brown_out()
+
+    def brown_out(self):
+        self.registers = {0x01: 0xFF, 0x02: 0x00, 0x03: 0xFF}
+
+    def read(self, register, length):
+        pins = (self.registers[0x01] & ~self.registers[0x03] | self.registers[0x03]) & 0xFF
+        return [pins if register + offset == 0x00 else self.registers.get(register + offset, 0) for offset in range(length)]
+
+    def channel_on(self, channel):
+        # Driven high only when the pin is an output
+        mask = 1 << (channel - 1)
+        return bool(self.registers[0x01] & mask and not self.registers[0x03] & mask)
+
+
+class SimPowerMonitor(SimDevice):
+    # Same scaling as Stack.get_current_sensor: 22 A and 57.3 V full scale, 12 bits
+    def __init__(self, world, expander, channel):
+        super().__init__(world)
+        self.expander = expander
+        self.channel = channel
+
+    def read(self, register, length):
+        if register != 0x00:
+            return super().read(register, length)
+        amps = (2.0 + 0.25 * self.channel if self.expander.channel_on(self.channel) else 0.05)
+        amps = self.world.noisy(amps)
+        volts = self.world.noisy(16.0)
+        a = max(0, min(4095, int(amps * 4095 / 22)))
+        v = max(0, min(4095, int(volts * 4095 / 57.3)))
+        return [a >> 4, (a & 0xF) << 4, v >> 4, (v & 0xF) << 4][:length]
+
+
+class SimBME280(SimDevice):
+    # Calibration from the datasheet example, raw values give about 25 C and 1006 hPa
+    T = (27504, 26435, -1000)
+    P = (36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+    H = (75, 362, 0, 313, 50, 30)
+
+    def __init__(self, world):
+        super().__init__(world)
+        self.registers[0xD0] = 0x60
+        self.write(0x88, struct.pack('<HhhHhhhhhhhh', *self.T, *self.P))
+        h1, h2, h3, h4, h5, h6 = self.H
+        self.registers[0xA1] = h1
+        self.write(0xE1, struct.pack('<hB', h2, h3) + bytes((
+            (h4 >> 4) & 0xFF, (h4 & 0xF) | ((h5 & 0xF) << 4), (h5 >> 4) & 0xFF, h6 & 0xFF)))
+
+    def read(self, register, length):
+        if register != 0xF7:
+            return super().read(register, length)
+        adc_p = int(self.world.noisy(415148, 0.1))
+        adc_t = int(self.world.noisy(519888, 0.1))
+        adc_h = int(self.world.noisy(30000, 0.1))
+        data = [adc_p >> 12 & 0xFF, adc_p >> 4 & 0xFF, (adc_p & 0xF) << 4,
+                adc_t >> 12 & 0xFF, adc_t >> 4 & 0xFF, (adc_t & 0xF) << 4,
+                adc_h >> 8 & 0xFF, adc_h & 0xFF]
+        return data[:length]
+
+
+class SimWorld:
+    """Devices on the I2C bus by mux path, with the state of every multiplexer.
+
+    Paths are (primary channel, secondary channel or None, address). The secondary
+    mux is behind primary channels 0 and 1, each of those has its own.
+    """
+
+    def __init__(self, latency=SIM_LATENCY, noise=SIM_NOISE, fault_rate=SIM_FAULT_RATE,
+                 boards=SIM_BOARDS, bmes=SIM_BMES):
+        self.latency = latency
+        self.noise = noise
+        self.fault_rate = fault_rate
+        self.lock = threading.RLock()
+        self.primary = None
+        self.secondary = {0: None, 1: None}
+        self.devices = {}
+        self.transactions = 0
+        self.faults = 0
+        for board in (int(b) for b in str(boards).split(',') if b.strip()):
+            self.add_board(board)
+        for bme in (b for b in str(bmes).split(',') if b.strip()):
+            primary, secondary = (int(c) for c in bme.split('/'))
+            self.devices[(primary, secondary, BME)] = SimBME280(self)
+        self.devices[(6, None, PWM_DRIVER)] = SimDevice(self)
+
+    def add_board(self, board):
+        expander = SimExpander(self)
+        self.devices[(2 + board, None, EXPANDER)] = expander
+        for channel, address in enumerate(POWER_MONITORS, 1):
+            self.devices[(2 + board, None, address)] = SimPowerMonitor(self, expander, channel)
+
+    def unplug(self, primary, secondary=None, address=None):
+        # Removes every device matching the given path prefix, e.g. a whole board
+        for path in list(self.devices):
+            if path[0] == primary and secondary in (None, path[1]) and address in (None, path[2]):
+                del self.devices[path]
+
+    def noisy(self, value, scale=1.0):
+        if not self.noise:
+            return value
+        return value * (1 + random.gauss(0, self.noise * scale))
+
+    def transaction_(self):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fault_rate and random.random() < self.fault_rate:
+            self.faults += 1
+            raise _remote_io_error()
+
+    def device_(self, address):
+        if self.primary is None:
+            raise _remote_io_error()
+        secondary = self.secondary.get(self.primary)
+        device = self.devices.get((self.primary, None, address))
+        if device is None and secondary is not None:
+            device = self.devices.get((self.primary, secondary, address))
+        if device is None:
+            raise _remote_io_error()
+        return device
+
+    def write(self, address, register, data):
+        with self.lock:
+            self.transaction_()
+            if address == PRIMARY_MUX:
+                # Register-less write of the channel bit mask
+                self.primary = data[0].bit_length() - 1 if data and data[0] else None
+                return
+            if address == SECONDARY_MUX and self.primary in self.secondary:
+                self.secondary[self.primary] = data[0].bit_length() - 1 if data and data[0] else None
+                return
+            self.device_(address).write(register, data)
+
+    def read(self, address, register, length):
+        with self.lock:
+            self.transaction_()
+            if address == PRIMARY_MUX:
+                return [0 if self.primary is None else 1 << self.primary][:length]
+            return self.device_(address).read(register, length)
+
+
+_world = None
+
+def world():
+    # One simulated bus per process, shared by the SMBus objects
+    global _world
+    if _world is None:
+        _world = SimWorld()
+    return _world
+
+
+class SMBus:
+    """Drop-in for smbus.SMBus on the simulated bus."""
+
+    def __init__(self, bus=1):
+        self.world = world()
+
+    def write_byte(self, address, value):
+        self.world.write(address, None, [value])
+
+    def read_byte(self, address):
+        return self.world.read(address, None, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        self.world.write(address, register, [value])
+
+    def read_byte_data(self, address, register):
+        return self.world.read(address, register, 1)[0]
+
+    def write_i2c_block_data(self, address, register, data):
+        self.world.write(address, register, list(data))
+
+    def read_i2c_block_data(self, address, register, length=32):
+        return self.world.read(address, register, length)
+
+    def close(self):
+        pass
+
+
+class _PWM:
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def stop(self):
+        self.duty_cycle = 0
+
+
+class GPIO:
+    """Drop-in for the RPi.GPIO module."""
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PWM = _PWM
+    pins = {}
+
+    @staticmethod
+    def setwarnings(flag):
+        pass
+
+    @staticmethod
+    def setmode(mode):
+        pass
+
+    @classmethod
+    def setup(cls, pin, direction, initial=0):
+        cls.pins[pin] = initial
+
+    @classmethod
+    def output(cls, pin, value):
+        cls.pins[pin] = value
+
+    @classmethod
+    def cleanup(cls):
+        cls.pins.clear()
+
+
+class Serial:
+    """Drop-in for serial.Serial connected to a simulated motor or LED Arduino.
+
+    Writes take their wire time at the current baud rate plus `latency`. The
+    firmware answers the serial_link handshake (unless configured as 'ascii') and
+    acknowledges every command, binary frames with an ack frame and ASCII lines with
+    "OK". The last byte of a reply is corrupted with probability `fault_rate`.
+    """
+
+    def __init__(self, port=None, baudrate=9600, timeout=None, write_timeout=None,
+                 protocol=SIM_SERIAL_PROTOCOL, latency=SIM_LATENCY, fault_rate=SIM_FAULT_RATE, **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.protocol = protocol
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.condition = threading.Condition()
+        self.replies = []  # (due time, bytes)
+        self.rx = bytearray()
+        self.line = b''
+        self.parser = serial_link.FrameParser()
+        self.drained_at = 0.0
+        self.is_open = True
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        if not self.is_open:
+            raise OSError(9, 'Bad file descriptor')
+        now = time.monotonic()
+        # Bytes leave one after the other, 10 bits each
+        self.drained_at = max(self.drained_at, now) + len(data) * 10.0 / self.baudrate
+        for reply in self.firmware_(bytes(data)):
+            if self.fault_rate and random.random() < self.fault_rate:
+                reply = reply[:-1] + bytes([reply[-1] ^ 0x5A])
+            with self.condition:
+                self.replies.append((self.drained_at + self.latency + len(reply) * 10.0 / self.baudrate, reply))
+        return len(data)
+
+    def flush(self):
+        delay = self.drained_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def firmware_(self, data):
+        replies = []
+        if self.protocol == 'binary':
+            for opcode, payload in self.parser.feed(data):
+                self.commands.append((opcode, payload))
+                if opcode == serial_link.OP_HELLO:
+                    replies.append(serial_link.encode(serial_link.OP_HELLO_ACK, bytes((serial_link.PROTOCOL_VERSION,))))
+                else:
+                    replies.append(serial_link.encode(serial_link.OP_ACK, bytes((opcode, 0))))
+            return replies
+        self.line += data
+        while b'\n' in self.line:
+            line, self.line = self.line.split(b'\n', 1)
+            line = line.strip()
+            if line.startswith((b'DIR:', b'BRIGHTNESS:')):
+                self.commands.append(line.decode())
+                replies.append(b'OK\r\n')
+        return replies
+
+    def deliver_(self):
+        now = time.monotonic()
+        with self.condition:
+            due = [reply for reply in self.replies if reply[0] <= now]
+            self.replies = [reply for reply in self.replies if reply[0] > now]
+        for _, reply in due:
+            self.rx += reply
+
+    @property
+    def in_waiting(self):
+        self.deliver_()
+        return len(self.rx)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            self.deliver_()
+            if len(self.rx) >= size or (deadline is not None and time.monotonic() >= deadline):
+                data = bytes(self.rx[:size])
+                del self.rx[:size]
+                return data
+            time.sleep(0.001)
+
+    def readline(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            self.deliver_()
+            end = self.rx.find(b'\n')
+            if end >= 0 or (deadline is not None and time.monotonic() >= deadline):
+                end = len(self.rx) if end < 0 else end + 1
+                data = bytes(self.rx[:end])
+                del self.rx[:end]
+                return data
+            time.sleep(0.001)
+
+    def reset_input_buffer(self):
+        self.deliver_()
+        self.rx.clear()
+
+    def reset_output_buffer(self):
+        pass
@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from fastapi import WebSocket, WebSocketDisconnect
+from loguru import logger
+
+# Push rate limits for /ws/telemetry subscribers (Hz)
+DEFAULT_RATE = 1.0
+MAX_RATE = 50.0
+
+
+def _lookup(retv, key):
+    # Sample keys are ints on the Stack side and strings once they went through JSON
+    if not isinstance(retv, dict):
+        return None
+    if key in retv:
+        return retv[key]
+    for k in retv:
+        if str(k) == key:
+            return retv[k]
+    return None
+
+
+def select_channels(sample, channels):
+    """Reduce a sample to the requested channel paths, e.g. "bme", "current/2" or "current/2/1"."""
+    if not channels:
+        return sample
+    retv = {'seq': sample.get('seq'), 'time': sample.get('time')}
+    for path in channels:
+        parts = str(path).strip('/').split('/')
+        src, dst = sample, retv
+        for part in parts[:-1]:
+            src = _lookup(src, part)
+            if not isinstance(src, dict):
+                break
+            dst = dst.setdefault(part, {})
+        else:
+            value = _lookup(src, parts[-1])
+            if value is not None:
+                dst[parts[-1]] = value
+    return retv
+
+
+def parse_channels(channels):
+    if channels is None:
+        return None
+    if isinstance(channels, str):
+        channels = channels.split(',')
+    return [str(c).strip() for c in channels if str(c).strip()] or None
+
+
+def parse_rate(rate):
+    try:
+        rate = float(rate)
+    except (TypeError, ValueError):
+        return DEFAULT_RATE
+    # 0 means "every sample", anything else is capped
+    if rate <= 0:
+        return 0.0
+    return min(rate, MAX_RATE)
+
+
+class TelemetrySubscriber:
+    def __init__(self, websocket: WebSocket, rate=DEFAULT_RATE, channels=None):
+        self.websocket = websocket
+        self.rate = parse_rate(rate)
+        self.channels = parse_channels(channels)
+        self.pending = None
+        self.last_sent = 0.0
+        self.wakeup = asyncio.Event()
+
+    def configure(self, rate=None, channels=None):
+        if rate is not None:
+            self.rate = parse_rate(rate)
+        if channels is not None:
+            self.channels = parse_channels(channels)
+
+    def offer(self, sample):
+        # Latest sample wins, a slow subscriber never sees a backlog
+        self.pending = sample
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if self.rate > 0:
+                delay = self.last_sent + 1.0 / self.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.wakeup.clear()
+            sample, self.pending = self.pending, None
+            if sample is None:
+                continue
+            self.last_sent = time.monotonic()
+            await self.websocket.send_json(select_channels(sample, self.channels))
+
+
+class TelemetryHub:
+    def __init__(self):
+        self.subscribers = set()
+        self.listeners = []
+        self.latest = None
+        self.loop = None
+        self.thread = None
+        self.live = None
+        self.source = None
+
+    def add_listener(self, listener):
+        # Called from the feed thread with every sample, before it reaches the event loop
+        self.listeners.append(listener)
+
+    def start(self, source, loop):
+        # The feed thread blocks on the acquisition process and hands samples to the event loop
+        self.loop = loop
+        self.live = self.source = source
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.feed_, daemon=True)
+            self.thread.start()
+
+    def replay(self, source):
+        # Subscribers get the replayed samples in place of the live ones until it ends
+        self.source = source
+
+    def stop_replay(self):
+        self.source = self.live
+
+    def replaying(self):
+        return self.source is not self.live
+
+    def feed_(self):
+        while True:
+            try:
+                source = self.source
+                sample = source.wait_for_sample(timeout=1.0)
+                if source is not self.live and source.finished:
+                    self.source = self.live
+                if sample is not None:
+                    # Listeners (history) only keep live data
+                    if source is self.live:
+                        for listener in self.listeners:
+                            listener(sample)
+                    self.loop.call_soon_threadsafe(self.publish, sample)
+            except Exception as e:
+                logger.error(f"Telemetry feed error: {e}")
+                time.sleep(0.5)
+
+    def publish(self, sample):
+        self.latest = sample
+        for subscriber in self.subscribers:
+            subscriber.offer(sample)
+
+    async def serve(self, websocket: WebSocket):
+        await websocket.accept()
+        params = websocket.query_params
+        subscriber = TelemetrySubscriber(websocket, params.get('rate', DEFAULT_RATE), params.get('channels'))
+        self.subscribers.add(subscriber)
+        if self.latest is not None:
+            subscriber.offer(self.latest)
+        sender = asyncio.create_task(subscriber.run())
+        try:
+            while True:
+                # Clients may change rate/channels at any time: {"rate": 10, "channels": ["current/2"]}
+                data = await websocket.receive_json()
+                if isinstance(data, dict):
+                    subscriber.configure(data.get('rate'), data.get('channels'))
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error(f"Telemetry WebSocket error: {e}")
+        finally:
+            self.subscribers.discard(subscriber)
+            sender.cancel()
+
+
+telemetry_hub = TelemetryHub()
@@ -0,0 +1,242 @@
+import time
+from array import array
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from metrics import LATENCY_BUCKETS
+
+# Fixed telemetry layout shared between the acquisition process and the API process
+BOARDS = 4
+CHANNELS = 4
+BME_SLOTS = 16
+CURRENT_FIELDS = ('current', 'volt', 'watt')
+BME_FIELDS = ('temperature', 'pressure', 'humidity')
+# Acquisition loop statistics, refreshed once per cycle
+STAT_FIELDS = (
+    'cycles', 'sweeps', 'cycle_time', 'mux_swaps', 'mux_swaps_skipped', 'current_reads', 'bme_reads', 'i2c_transactions', 'i2c_errors', 'output_repairs', 'pwm_moving',
+    'actuation_jobs', 'actuation_queued', 'actuation_wait_mean', 'actuation_wait_max', 'actuation_deadline_misses',
+    'telemetry_jobs', 'telemetry_queued', 'telemetry_wait_mean', 'telemetry_wait_max', 'telemetry_deadline_misses',
+)
+# Latency histograms kept by the acquisition loop: bucket counts, then sum and count
+HISTOGRAMS = ('command_queue', 'command_dispatch', 'command_apply', 'sweep',
+              'job_read_current', 'job_trigger_bme', 'job_read_bme', 'job_apply_command', 'job_end_cycle',
+              'job_trajectory_tick')
+_HISTOGRAM_WIDTH = len(LATENCY_BUCKETS) + 3
+
+# Offsets in float64 slots, after the 8 byte sequence counter
+_TIME = 0
+_CURRENT = 1
+_CURRENT_VALID = _CURRENT + BOARDS * CHANNELS * len(CURRENT_FIELDS)
+_BME = _CURRENT_VALID + BOARDS * CHANNELS
+_BME_VALID = _BME + BME_SLOTS * len(BME_FIELDS)
+_STATS = _BME_VALID + BME_SLOTS
+_HISTOGRAMS = _STATS + len(STAT_FIELDS)
+_TOPOLOGY = _HISTOGRAMS + len(HISTOGRAMS) * _HISTOGRAM_WIDTH
+# Discovery state, then one presence flag per board and per BME slot
+_OUTPUTS = _TOPOLOGY + 1 + BOARDS + BME_SLOTS
+# Per board: requested output register, output pins as last read back (-1 until known),
+# time of that readback
+_OUTPUT_FIELDS = 3
+_SLOTS = _OUTPUTS + BOARDS * _OUTPUT_FIELDS
+
+# A reader gives up waiting for a writer that died mid-update after this long
+_READ_TIMEOUT = 0.05
+
+
+class TelemetryBlock:
+    """Array-backed telemetry snapshot in shared memory, guarded by a sequence counter.
+
+    There is a single writer (the acquisition loop). The counter is odd while a write
+    is in progress, so readers copy the block and retry until they see the same even
+    value before and after the copy. Readers never block the writer. A reader that
+    times out gets its last consistent copy, marked stale, never a torn one.
+    """
+
+    def __init__(self, name=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=8 + 8 * _SLOTS)
+        self.seq = self.shm.buf[:8].cast('Q')
+        self.values = self.shm.buf[8:8 + 8 * _SLOTS].cast('d')
+        if name is None:
+            # Nothing requested or read back yet
+            self.values[_OUTPUTS:_SLOTS] = array('d', [-1.0, -1.0, 0.0] * BOARDS)
+        # Last consistent snapshot seen by this reader, and reads that fell back to it
+        self.last_ = None
+        self.stale_reads = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # ____________________________ Writer side ____________________________ #
+
+    def begin_write(self):
+        self.seq[0] += 1
+
+    def end_write(self):
+        self.values[_TIME] = time.time()
+        self.seq[0] += 1
+
+    @contextmanager
+    def writing(self):
+        # The counter is made even again even when an update fails half way
+        self.begin_write()
+        try:
+            yield self
+        finally:
+            self.end_write()
+
+    def write_current(self, board, channel, sample, stamp=None):
+        if not (0 <= board < BOARDS and 1 <= channel <= CHANNELS):
+            return
+        index = board * CHANNELS + channel - 1
+        if not isinstance(sample, dict):
+            sample = {'current': -1, 'volt': -1, 'watt': -1}
+        base = _CURRENT + index * len(CURRENT_FIELDS)
+        for offset, field in enumerate(CURRENT_FIELDS):
+            self.values[base + offset] = sample.get(field, -1)
+        # The valid slot holds the time of the reading, 0 until the first one
+        self.values[_CURRENT_VALID + index] = stamp or time.time()
+
+    def write_bme(self, slot, sample, stamp=None):
+        if not 1 <= slot <= BME_SLOTS:
+            return
+        base = _BME + (slot - 1) * len(BME_FIELDS)
+        for offset, field in enumerate(BME_FIELDS):
+            self.values[base + offset] = sample[field]
+        self.values[_BME_VALID + slot - 1] = stamp or time.time()
+
+    def clear_current(self, board):
+        # The board is gone, its channels read as missing until it comes back
+        if 0 <= board < BOARDS:
+            self.values[_CURRENT_VALID + board * CHANNELS:_CURRENT_VALID + (board + 1) * CHANNELS] = array('d', [0.0] * CHANNELS)
+
+    def clear_bme(self, slot):
+        if 1 <= slot <= BME_SLOTS:
+            self.values[_BME_VALID + slot - 1] = 0.0
+
+    def write_topology(self, state, boards, bme_slots):
+        # state is an index into Stack.DISCOVERY_STATES
+        self.values[_TOPOLOGY] = state
+        for board in range(BOARDS):
+            self.values[_TOPOLOGY + 1 + board] = board in boards
+        for slot in range(1, BME_SLOTS + 1):
+            self.values[_TOPOLOGY + BOARDS + slot] = slot in bme_slots
+
+    def write_outputs(self, board, requested, actual, stamp):
+        if 0 <= board < BOARDS:
+            base = _OUTPUTS + board * _OUTPUT_FIELDS
+            self.values[base:base + _OUTPUT_FIELDS] = array('d', [
+                -1 if requested is None else requested, -1 if actual is None else actual, stamp or 0.0])
+
+    def write_stats(self, stats):
+        for index, field in enumerate(STAT_FIELDS):
+            if field in stats:
+                self.values[_STATS + index] = stats[field]
+
+    def write_histograms(self, histograms):
+        # histograms: name -> metrics.Histogram
+        for index, name in enumerate(HISTOGRAMS):
+            if name not in histograms:
+                continue
+            counts, total, count = histograms[name].snapshot()
+            base = _HISTOGRAMS + index * _HISTOGRAM_WIDTH
+            self.values[base:base + _HISTOGRAM_WIDTH] = array('d', counts + [total, count])
+
+    # ____________________________ Reader side ____________________________ #
+
+    def snapshot_(self):
+        # (sequence, values, stale). Raises TimeoutError if no consistent copy was ever read.
+        deadline = time.monotonic() + _READ_TIMEOUT
+        while True:
+            start = self.seq[0]
+            raw = self.values.tolist()
+            if not (start & 1) and self.seq[0] == start:
+                self.last_ = (start // 2, raw)
+                return start // 2, raw, False
+            if time.monotonic() > deadline:
+                self.stale_reads += 1
+                if self.last_ is None:
+                    raise TimeoutError("Telemetry block is stuck in a write")
+                return self.last_ + (True,)
+            time.sleep(0)
+
+    @staticmethod
+    def current_from_(raw):
+        retv = {}
+        for board in range(BOARDS):
+            for channel in range(1, CHANNELS + 1):
+                index = board * CHANNELS + channel - 1
+                if not raw[_CURRENT_VALID + index]:
+                    continue
+                base = _CURRENT + index * len(CURRENT_FIELDS)
+                reading = {field: raw[base + offset] for offset, field in enumerate(CURRENT_FIELDS)}
+                reading['time'] = raw[_CURRENT_VALID + index]
+                retv.setdefault(board, {})[channel] = reading
+        return retv
+
+    @staticmethod
+    def bme_from_(raw):
+        retv = {}
+        for slot in range(1, BME_SLOTS + 1):
+            if not raw[_BME_VALID + slot - 1]:
+                continue
+            base = _BME + (slot - 1) * len(BME_FIELDS)
+            reading = {field: raw[base + offset] for offset, field in enumerate(BME_FIELDS)}
+            reading['time'] = raw[_BME_VALID + slot - 1]
+            retv[slot] = reading
+        return retv
+
+    def read_current(self):
+        return self.current_from_(self.snapshot_()[1])
+
+    def read_bme(self):
+        return self.bme_from_(self.snapshot_()[1])
+
+    def read_stats(self):
+        raw = self.snapshot_()[1]
+        return {field: raw[_STATS + index] for index, field in enumerate(STAT_FIELDS)}
+
+    def read_histograms(self):
+        # name -> (counts, sum, count), bucket bounds are metrics.LATENCY_BUCKETS
+        raw = self.snapshot_()[1]
+        retv = {}
+        for index, name in enumerate(HISTOGRAMS):
+            base = _HISTOGRAMS + index * _HISTOGRAM_WIDTH
+            row = raw[base:base + _HISTOGRAM_WIDTH]
+            retv[name] = (row[:-2], row[-2], row[-1])
+        return retv
+
+    def read_topology(self):
+        # (state, boards, bme slots) as last written by the acquisition process
+        raw = self.snapshot_()[1]
+        boards = [board for board in range(BOARDS) if raw[_TOPOLOGY + 1 + board]]
+        slots = [slot for slot in range(1, BME_SLOTS + 1) if raw[_TOPOLOGY + BOARDS + slot]]
+        return int(raw[_TOPOLOGY]), boards, slots
+
+    def read_outputs(self):
+        # board -> {'requested': [..], 'actual': [..], 'verified': time}, on/off per channel 1 to 4
+        raw = self.snapshot_()[1]
+        retv = {}
+        for board in range(BOARDS):
+            requested, actual, stamp = raw[_OUTPUTS + board * _OUTPUT_FIELDS:_OUTPUTS + (board + 1) * _OUTPUT_FIELDS]
+            if requested < 0 and actual < 0:
+                continue
+            retv[board] = {
+                'requested': [bool(int(requested) >> bit & 1) for bit in range(CHANNELS)] if requested >= 0 else None,
+                'actual': [bool(int(actual) >> bit & 1) for bit in range(CHANNELS)] if actual >= 0 else None,
+                'verified': stamp or None,
+            }
+        return retv
+
+    def read(self):
+        seq, raw, stale = self.snapshot_()
+        retv = {'seq': seq, 'time': raw[_TIME], 'current': self.current_from_(raw), 'bme': self.bme_from_(raw)}
+        if stale:
+            retv['stale'] = True
+        return retv
+
+    def close(self, unlink=False):
+        self.seq.release()
+        self.values.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()